@@ -0,0 +1,142 @@
+"""Console and log output that never blocks the trading thread.
+
+Writes to a QueuedStream and records sent to a QueuedLogHandler go on one
+bounded queue, and a background thread does the actual writing, in order.
+If the terminal or log file falls so far behind that the queue fills up,
+further output is dropped rather than waited on. The drops are counted in
+OutputQueue.num_dropped and reported on the console once it catches up.
+
+    output = install()      # sys.stdout and the root logger now queue
+    ...
+    output.flush()          # wait for everything queued so far
+"""
+
+from __future__ import print_function
+
+import atexit
+import logging
+import sys
+import threading
+
+try:
+    import queue
+except ImportError:
+    # Python 2
+    import Queue as queue
+
+
+class OutputQueue(object):
+    def __init__(self, max_queued=10000):
+        self._queue = queue.Queue(max_queued)
+        self._console = None
+        self._lock = threading.Lock()
+        self.num_dropped = 0
+        self._num_unreported = 0
+        thread = threading.Thread(target=self._write_queued,
+                                  name='OutputQueue')
+        thread.daemon = True
+        thread.start()
+
+    def stream(self, target):
+        """A file-like object whose writes are queued for `target`. The
+        first stream made is where drops are reported."""
+        if self._console is None:
+            self._console = target
+        return QueuedStream(self, target)
+
+    def log_handler(self, target):
+        """A logging.Handler that queues records for handler `target`."""
+        return QueuedLogHandler(self, target)
+
+    def put(self, func, *args):
+        try:
+            self._queue.put_nowait((func, args))
+        except queue.Full:
+            with self._lock:
+                self.num_dropped += 1
+                self._num_unreported += 1
+
+    def _write_queued(self):
+        while True:
+            func, args = self._queue.get()
+            try:
+                func(*args)
+                if self._queue.empty():
+                    self._caught_up()
+            except Exception:
+                # Nowhere sensible to report it, and the thread must live
+                pass
+            finally:
+                self._queue.task_done()
+
+    def _caught_up(self):
+        with self._lock:
+            num_unreported, self._num_unreported = self._num_unreported, 0
+        if num_unreported > 0 and self._console is not None:
+            self._console.write(
+                '\n[output queue full, dropped {} writes, {} in total]\n'
+                .format(num_unreported, self.num_dropped))
+        if self._console is not None:
+            self._console.flush()
+
+    def flush(self):
+        """Wait until everything queued so far has been written."""
+        self._queue.join()
+
+
+class QueuedStream(object):
+    def __init__(self, output_queue, target):
+        self._output_queue = output_queue
+        self._target = target
+
+    def write(self, text):
+        self._output_queue.put(self._target.write, text)
+
+    def flush(self):
+        # The writer flushes whenever it catches up
+        pass
+
+    def __getattr__(self, name):
+        # encoding, isatty() and the like
+        return getattr(self._target, name)
+
+
+class QueuedLogHandler(logging.Handler):
+    def __init__(self, output_queue, target):
+        logging.Handler.__init__(self)
+        self._output_queue = output_queue
+        self._target = target
+
+    def emit(self, record):
+        # Format the message now, its arguments may change before the
+        # writer gets to it
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        self._output_queue.put(self._target.handle, record)
+
+
+_installed = None
+
+
+def install(max_queued=10000):
+    """Queue sys.stdout and every handler on the root logger through one
+    OutputQueue, flushed at exit. Only installs once, returns the
+    OutputQueue."""
+    global _installed
+    if _installed is not None:
+        return _installed
+
+    output = OutputQueue(max_queued)
+    sys.stdout = output.stream(sys.stdout)
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+        root.addHandler(output.log_handler(handler))
+    atexit.register(output.flush)
+
+    _installed = output
+    return output
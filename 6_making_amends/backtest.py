@@ -0,0 +1,360 @@
+"""Run the strategies in strats.py against recorded market data, in virtual
+time.
+
+A SimClock stands in for the `time` module in strats.py, so every
+time.sleep() just moves the clock on. The StockPurse handed to the strategy
+talks to a ReplayVenue instead of the API. The ReplayVenue is a venue_sim
+SimVenue whose book is reset to each recorded orderbook as the clock passes
+it, so our orders trade against what was actually on the book. Recorded
+quotes whose last trade went through one of our resting orders fill it too.
+
+Recordings are files with one API response per line, either orderbooks or
+quotes (bare, or wrapped as a tickertape message), or capture files from
+capture.py, e.g.
+
+    python backtest.py recording.jsonl shy_maker num_rounds=30 wait_secs=4
+
+--start and --end replay just that window. A capture seeks straight to it.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import sys
+
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+import strats
+from capture import BOOK, QUOTE, CaptureReader, is_capture
+from lib import StockPurse, parse_ts
+from venue_sim import OrderError, SimVenue
+
+
+REPLAY_ACCOUNT = 'REPLAY'
+
+
+class ReplayFinished(Exception):
+    """The clock has run past the end of the recording."""
+
+
+class SimClock:
+    """The parts of the `time` module that strategies use, in virtual time.
+
+    sleep() returns straight away, after advancing the clock and letting
+    whatever was registered with on_advance() catch up."""
+
+    def __init__(self, start, end=None):
+        self._now = start
+        self._end = end
+        self._listeners = []
+
+    def on_advance(self, listener):
+        self._listeners.append(listener)
+
+    def time(self):
+        return self._now
+
+    monotonic = time
+
+    def sleep(self, secs):
+        self.advance(secs)
+
+    def advance(self, secs):
+        if secs > 0:
+            self._now += secs
+        if self._end is not None and self._now > self._end:
+            raise ReplayFinished()
+        for listener in self._listeners:
+            listener(self._now)
+
+
+def load_recording(path, start=None, end=None):
+    """Return [(ts, kind, message)] sorted by time, kind is 'orderbook' or
+    'quote'. With `start` and/or `end`, in seconds since the epoch, only
+    the events in that window."""
+    if is_capture(path):
+        return load_capture(path, start, end)
+
+    events = []
+    with open(path) as fp:
+        for line in fp:
+            line = line.strip()
+            if not line:
+                continue
+            message = json.loads(line)
+            if 'quote' in message:
+                message = message['quote']
+            if 'bids' in message or 'asks' in message:
+                events.append((parse_ts(message['ts']), 'orderbook', message))
+            elif 'quoteTime' in message:
+                events.append(
+                    (parse_ts(message['quoteTime']), 'quote', message))
+    events = [event for event in events
+              if (start is None or event[0] >= start) and
+              (end is None or event[0] <= end)]
+    events.sort(key=lambda event: event[0])
+    return events
+
+
+def load_capture(path, start=None, end=None):
+    """load_recording() for a capture file, reading only the window."""
+    reader = CaptureReader(path)
+    try:
+        events = []
+        for view in reader.messages(start, end, kinds=(BOOK, QUOTE)):
+            ts = view.ts
+            # Like quotes without a quoteTime in a recording, unplaceable
+            if ts == 0.0 or (start is not None and ts < start):
+                continue
+            events.append(
+                (ts, view.kind, view.to_json(reader.venue, reader.symbol)))
+    finally:
+        reader.close()
+    events.sort(key=lambda event: event[0])
+    return events
+
+
+def parse_time(text):
+    """Seconds since the epoch for a venue timestamp or a number."""
+    try:
+        return float(text)
+    except ValueError:
+        return parse_ts(text)
+
+
+class ReplayVenue:
+    """A SimVenue for one stock that replays `events`, see load_recording(),
+    as `clock` advances."""
+
+    def __init__(self, venue, symbol, events, clock):
+        self.venue = venue
+        self.symbol = symbol
+        self.sim = SimVenue([(venue, symbol)])
+        self._events = events
+        self._next_event = 0
+        self._replay_orders = []
+        self._last_trade = None
+        clock.on_advance(self.advance_to)
+        self.advance_to(clock.time())
+
+    def advance_to(self, now):
+        while (self._next_event < len(self._events) and
+               self._events[self._next_event][0] <= now):
+            _, kind, message = self._events[self._next_event]
+            self._next_event += 1
+            if kind == 'orderbook':
+                self._replay_orderbook(message)
+            else:
+                self._replay_quote(message)
+
+    def _replay_orderbook(self, orderbook):
+        book = self.sim.book(self.venue, self.symbol)
+        for order in self._replay_orders:
+            book.cancel(order)
+        self._replay_orders = []
+
+        # Recorded bids go in first, any that cross our resting asks fill
+        # them, then the same for asks against our bids
+        for direction, levels in (('buy', orderbook.get('bids')),
+                                  ('sell', orderbook.get('asks'))):
+            for level in levels or []:
+                order = self.sim.place(
+                    self.venue, self.symbol, REPLAY_ACCOUNT, direction,
+                    'limit', level['qty'], level['price'])
+                if order.open:
+                    self._replay_orders.append(order)
+
+    def _replay_quote(self, quote):
+        if 'last' not in quote or quote.get('lastTrade') == self._last_trade:
+            return
+        self._last_trade = quote.get('lastTrade')
+
+        # Somebody traded at `last`, so any of our orders at that price or
+        # better would have been in the way
+        book = self.sim.book(self.venue, self.symbol)
+        bid, ask = book.best_bid(), book.best_ask()
+        if bid is not None and bid >= quote['last']:
+            self.sim.place(self.venue, self.symbol, REPLAY_ACCOUNT, 'sell',
+                           'immediate-or-cancel', quote['lastSize'],
+                           quote['last'])
+        elif ask is not None and ask <= quote['last']:
+            self.sim.place(self.venue, self.symbol, REPLAY_ACCOUNT, 'buy',
+                           'immediate-or-cancel', quote['lastSize'],
+                           quote['last'])
+
+
+class SimResponse:
+    """The parts of requests.Response that StockPurse uses."""
+
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.text = json.dumps(body)
+        self.content = self.text.encode('utf-8')
+        self._body = body
+
+    def json(self):
+        return self._body
+
+
+class SimSession:
+    """Drop-in for APISession that calls straight into a ReplayVenue. Every
+    call costs `latency` seconds of virtual time."""
+
+    def __init__(self, replay_venue, clock, latency=0.001):
+        self._sim = replay_venue.sim
+        self._clock = clock
+        self._latency = latency
+
+    def _call(self, func, *args):
+        self._clock.advance(self._latency)
+        try:
+            return SimResponse(200, func(*args))
+        except OrderError as e:
+            return SimResponse(e.status_code,
+                               {'ok': False, 'error': e.error_msg})
+
+    def quote(self, venue, stock):
+        return self._call(lambda: self._sim.book(venue, stock).quote_json())
+
+    def orderbook(self, venue, stock):
+        return self._call(
+            lambda: self._sim.book(venue, stock).orderbook_json())
+
+    def buy(self, venue, stock, account, type, qty, price=None):
+        return self.order(venue, stock, account, type, qty, 'buy', price)
+
+    def sell(self, venue, stock, account, type, qty, price=None):
+        return self.order(venue, stock, account, type, qty, 'sell', price)
+
+    def order(self, venue, stock, account, type, qty, direction, price=None):
+        return self._call(lambda: self._sim.place(
+            venue, stock, account, direction, type, qty, price).to_json())
+
+    def cancel_order(self, venue, stock, order):
+        def cancel():
+            status = self._sim.order_status(venue, stock, order)
+            return self._sim.cancel(
+                venue, stock, status.account, order).to_json()
+        return self._call(cancel)
+
+
+class SimAsyncSession:
+    """Drop-in for AsyncAPISession over a SimSession. The Futures it returns
+    are already resolved, concurrent requests cost one `latency` between
+    them: the requests made in one pass of the IOLoop are a batch, the
+    first moves the clock on and they all run at that time."""
+
+    def __init__(self, sim_session):
+        self._sim_session = sim_session
+        self._in_batch = False
+
+    def _end_batch(self):
+        self._in_batch = False
+
+    def _resolved(self, func, *args):
+        session = self._sim_session
+        if not self._in_batch:
+            session._clock.advance(session._latency)
+            self._in_batch = True
+            IOLoop.current().add_callback(self._end_batch)
+        latency = session._latency
+        session._latency = 0
+        try:
+            resp = func(*args)
+        finally:
+            session._latency = latency
+        future = Future()
+        future.set_result(resp)
+        return future
+
+    def quote(self, venue, stock):
+        return self._resolved(self._sim_session.quote, venue, stock)
+
+    def orderbook(self, venue, stock):
+        return self._resolved(self._sim_session.orderbook, venue, stock)
+
+    def buy(self, venue, stock, account, type, qty, price=None):
+        return self.order(venue, stock, account, type, qty, 'buy', price)
+
+    def sell(self, venue, stock, account, type, qty, price=None):
+        return self.order(venue, stock, account, type, qty, 'sell', price)
+
+    def order(self, venue, stock, account, type, qty, direction, price=None):
+        return self._resolved(self._sim_session.order, venue, stock, account,
+                              type, qty, direction, price)
+
+    def cancel_order(self, venue, stock, order):
+        return self._resolved(self._sim_session.cancel_order, venue, stock,
+                              order)
+
+
+def run_backtest(strategy, events, params=None, venue='TESTEX',
+                 stock='FOOBAR', account='BACKTEST', latency=0.001,
+                 quiet=False):
+    """Run `strategy`, a function from strats.py taking a StockPurse, over
+    `events` from load_recording(). Returns the purse once the strategy
+    finishes or the recording runs out."""
+    clock = SimClock(events[0][0], events[-1][0])
+    replay_venue = ReplayVenue(venue, stock, events, clock)
+    session = SimSession(replay_venue, clock, latency)
+    purse = StockPurse(venue, stock, account, session=session,
+                       async_session=SimAsyncSession(session))
+
+    real_time, real_stdout = strats.time, sys.stdout
+    strats.time = clock
+    # Jitter the probes' retries the same way every run, so results repeat
+    strats.PROBE_RETRY.seed(0)
+    if quiet:
+        sys.stdout = open(os.devnull, 'w')
+    try:
+        strategy(purse, **(params or {}))
+    except ReplayFinished:
+        pass
+    finally:
+        strats.time = real_time
+        if quiet:
+            sys.stdout.close()
+            sys.stdout = real_stdout
+
+    return purse
+
+
+def parse_params(args):
+    """['qty=60', 'qtys=[50,100]'] to {'qty': 60, 'qtys': [50, 100]}, values
+    that aren't JSON are kept as strings."""
+    params = {}
+    for arg in args:
+        name, _, value = arg.partition('=')
+        try:
+            params[name] = json.loads(value)
+        except ValueError:
+            params[name] = value
+    return params
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('recording')
+    parser.add_argument('strategy', help='Function name in strats.py')
+    parser.add_argument('params', nargs='*', metavar='NAME=VALUE')
+    parser.add_argument('--latency', type=float, default=0.001,
+                        help='Virtual seconds per API call')
+    parser.add_argument('--quiet', action='store_true')
+    parser.add_argument('--start', type=parse_time,
+                        help='Venue timestamp or epoch seconds to start at')
+    parser.add_argument('--end', type=parse_time,
+                        help='Venue timestamp or epoch seconds to stop at')
+    args = parser.parse_args()
+
+    events = load_recording(args.recording, args.start, args.end)
+    purse = run_backtest(getattr(strats, args.strategy), events,
+                         parse_params(args.params), latency=args.latency,
+                         quiet=args.quiet)
+    print(purse)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""Time the client stack against an in-process venue_sim server, so numbers
+are repeatable and don't depend on the live venue.
+
+    python bench_client.py --rounds 200
+"""
+
+from __future__ import print_function
+
+import argparse
+
+from lib import *
+from throttle import BUDGETS, Throttle
+from venue_sim import SimVenue, start_in_thread
+
+
+VENUE = 'TESTEX'
+STOCK = 'FOOBAR'
+ACCOUNT = 'BENCH001'
+# Far enough below the seeded book that every bid rests
+LADDER = [(1000 - 10 * level, 100) for level in range(6)]
+
+
+def unthrottled_session(url_base):
+    """An APISession whose throttle never holds a request back, so the
+    numbers are the client stack's."""
+    return APISession(url_base,
+                      throttle=Throttle(dict.fromkeys(BUDGETS, 1e9)))
+
+
+def percentile(samples, pct):
+    samples = sorted(samples)
+    idx = min(int(len(samples) * pct / 100.0), len(samples) - 1)
+    return samples[idx]
+
+
+def report(name, samples):
+    print('{:<34} n={:>5}  p50 {:>8.3f} ms  p99 {:>8.3f} ms  max {:>8.3f} ms'
+          .format(name, len(samples), 1000 * percentile(samples, 50),
+                  1000 * percentile(samples, 99), 1000 * max(samples)))
+
+
+def timed(func):
+    start = monotonic()
+    func()
+    return monotonic() - start
+
+
+def bench_order_cancel(purse, rounds):
+    samples = []
+    for _ in range(rounds):
+        samples.append(timed(lambda: purse.cancel(
+            purse.buy('limit', 100, LADDER[0][0]).id)))
+    report('order + cancel, blocking', samples)
+
+
+def bench_ladder(purse, rounds, name, send):
+    samples = []
+    for _ in range(rounds):
+        samples.append(timed(lambda: send(purse)))
+        purse.cancel_all(concurrent=True)
+    report(name, samples)
+
+
+def bench_cancel_all(purse, rounds, concurrent):
+    samples = []
+    for _ in range(rounds):
+        purse.submit_ladder('buy', LADDER)
+        samples.append(timed(lambda: purse.cancel_all(concurrent=concurrent)))
+    report('cancel_all of {} orders, {}'.format(
+        len(LADDER), 'concurrent' if concurrent else 'serial'), samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rounds', type=int, default=100)
+    args = parser.parse_args()
+
+    venue_sim = SimVenue([(VENUE, STOCK)])
+    venue_sim.seed(VENUE, STOCK, 5000)
+    url_base = start_in_thread(venue_sim)
+
+    purse = StockPurse(VENUE, STOCK, ACCOUNT, url_base=url_base,
+                       session=unthrottled_session(url_base))
+    pipelined_purse = StockPurse(VENUE, STOCK, ACCOUNT, url_base=url_base,
+                                 pipelining=True,
+                                 session=unthrottled_session(url_base))
+
+    bench_order_cancel(purse, args.rounds)
+
+    ladder_name = 'ladder of {} orders, '.format(len(LADDER))
+    bench_ladder(purse, args.rounds, ladder_name + 'serial',
+                 lambda p: [p.buy('limit', qty, price) for price, qty in LADDER])
+    bench_ladder(purse, args.rounds, ladder_name + 'concurrent',
+                 lambda p: p.submit_ladder('buy', LADDER))
+    bench_ladder(pipelined_purse, args.rounds, ladder_name + 'pipelined',
+                 lambda p: p.submit_ladder('buy', LADDER))
+
+    bench_cancel_all(purse, args.rounds, concurrent=False)
+    bench_cancel_all(purse, args.rounds, concurrent=True)
+
+    print('\nPer endpoint, blocking and concurrent:')
+    print(purse.latency.report())
+    print('\nPer endpoint, pipelined:')
+    print(pipelined_purse.latency.report())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""Decode time per orderbook response for each installed JSON backend.
+
+Payloads are the orderbooks in a recording, see backtest.py, or otherwise
+deep books generated with venue_sim:
+
+    python bench_decode.py --recording recording.jsonl
+    python bench_decode.py --levels 200 --payloads 500
+"""
+
+from __future__ import print_function
+
+import argparse
+import gc
+import json
+import random
+
+from jsondecode import BACKENDS
+from latency import monotonic
+from venue_sim import SimVenue
+
+
+def recorded_payloads(path):
+    payloads = []
+    with open(path, 'rb') as fp:
+        for line in fp:
+            line = line.strip()
+            if line and b'"bids"' in line:
+                payloads.append(line)
+    return payloads
+
+
+def generated_payloads(num_payloads, levels, seed=0):
+    """Orderbook responses from a venue_sim book `levels` deep on each
+    side, reshuffled a little between payloads."""
+    rand = random.Random(seed)
+    sim = SimVenue([('TESTEX', 'FOOBAR')])
+    sim.seed('TESTEX', 'FOOBAR', 5000, levels=levels)
+    book = sim.book('TESTEX', 'FOOBAR')
+    payloads = []
+    for _ in range(num_payloads):
+        for _ in range(10):
+            direction = 'buy' if rand.random() < 0.5 else 'sell'
+            offset = rand.randint(30, 30 + 10 * levels)
+            price = 5000 - offset if direction == 'buy' else 5000 + offset
+            sim.place('TESTEX', 'FOOBAR', 'BENCH', direction, 'limit',
+                      rand.randint(1, 500), price)
+        payloads.append(json.dumps(book.orderbook_json()).encode('utf-8'))
+    return payloads
+
+
+def bench(name, func, payloads, repeat):
+    best = None
+    # As timeit does, so collections triggered by earlier runs don't count
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = monotonic()
+            for payload in payloads:
+                func(payload)
+            elapsed = monotonic() - start
+            best = elapsed if best is None else min(best, elapsed)
+    finally:
+        gc.enable()
+    num_bytes = sum(len(payload) for payload in payloads)
+    print('{:<24} {:>9.1f} us/payload {:>9.1f} MB/s'
+          .format(name, 1e6 * best / len(payloads), num_bytes / best / 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--recording')
+    parser.add_argument('--payloads', type=int, default=200)
+    parser.add_argument('--levels', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Best of this many passes')
+    args = parser.parse_args()
+
+    if args.recording:
+        payloads = recorded_payloads(args.recording)
+    else:
+        payloads = generated_payloads(args.payloads, args.levels)
+    print('{} payloads, {:.1f} KB on average'.format(
+        len(payloads),
+        sum(len(payload) for payload in payloads) / 1000.0 / len(payloads)))
+
+    # What requests' resp.json() does
+    bench('requests-style json', lambda payload: json.loads(
+        payload.decode('utf-8')), payloads, args.repeat)
+    for name in sorted(BACKENDS):
+        loads = BACKENDS[name]
+        bench(name, loads, payloads, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""Orders/sec through the venue_sim matching engine, with no HTTP or JSON
+in the way.
+
+    python bench_matching.py --orders 200000
+"""
+
+from __future__ import print_function
+
+import argparse
+import itertools
+import random
+
+from latency import monotonic
+from matching import MatchingEngine
+
+
+def order_flow(num_orders, mid=5000, spread=200, seed=0):
+    """Yield ('order', direction, order_type, qty, price) and ('cancel',)
+    actions. Mostly limit orders around `mid`, some marketable, some
+    cancels. Seeded, so every run sees the same flow."""
+    rand = random.Random(seed)
+    for _ in range(num_orders):
+        roll = rand.random()
+        direction = 'buy' if rand.random() < 0.5 else 'sell'
+        qty = rand.randint(1, 500)
+        if roll < 0.2:
+            yield ('cancel',)
+        elif roll < 0.3:
+            yield ('order', direction, 'market', qty, None)
+        elif roll < 0.35:
+            yield ('order', direction, 'immediate-or-cancel', qty,
+                   mid + rand.randint(-spread, spread))
+        else:
+            # Limit orders mostly rest on their own side of the mid
+            offset = rand.randint(-spread // 4, spread)
+            price = mid - offset if direction == 'buy' else mid + offset
+            yield ('order', direction, 'limit', qty, price)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--orders', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    actions = list(order_flow(args.orders, seed=args.seed))
+    engine = MatchingEngine('TESTEX', 'FOOBAR', itertools.count(1))
+    rand = random.Random(args.seed)
+    resting = []
+    num_fills = 0
+
+    start = monotonic()
+    for action in actions:
+        if action[0] == 'cancel':
+            if len(resting) > 0:
+                idx = rand.randrange(len(resting))
+                resting[idx], resting[-1] = resting[-1], resting[idx]
+                engine.cancel(resting.pop())
+            continue
+        _, direction, order_type, qty, price = action
+        order, fills = engine.submit('BENCH', direction, order_type, qty,
+                                     price)
+        num_fills += len(fills)
+        if order.open:
+            resting.append(order)
+    elapsed = monotonic() - start
+
+    print('{} actions ({} fills) in {:.3f} s: {:,.0f} actions/sec'
+          .format(len(actions), num_fills, elapsed, len(actions) / elapsed))
+    print('Book at end: best bid {}, best ask {}'
+          .format(engine.best_bid(), engine.best_ask()))
+
+
+if __name__ == '__main__':
+    main()
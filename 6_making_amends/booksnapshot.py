@@ -0,0 +1,308 @@
+"""An orderbook as arrays, for the depth questions strategies ask of it.
+
+Each side is its prices and qtys, best first, plus the running total of qty
+from the best price down. How far into the book a qty reaches is then a
+binary search on the running total rather than a walk over the levels.
+Uses NumPy when installed, otherwise `array` and `bisect`.
+
+diff_snapshots() gives the levels added, removed and changed between two
+snapshots. A BookDeltaStream hands each diff to subscribers such as
+InformedOrderDetector and LadderPricer, which only redo work for the
+levels that changed.
+"""
+
+from __future__ import print_function
+
+import bisect
+import collections
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def _cumsum(qtys):
+    if numpy is not None:
+        return numpy.cumsum(qtys)
+    cum_qtys = array('l', qtys)
+    for idx in range(1, len(cum_qtys)):
+        cum_qtys[idx] += cum_qtys[idx - 1]
+    return cum_qtys
+
+
+class SnapshotSide(object):
+    __slots__ = ('prices', 'qtys', 'cum_qtys')
+
+    def __init__(self, prices, qtys):
+        if numpy is not None:
+            prices = numpy.asarray(prices, dtype=numpy.int64)
+            qtys = numpy.asarray(qtys, dtype=numpy.int64)
+        self.prices = prices
+        self.qtys = qtys
+        self.cum_qtys = _cumsum(qtys)
+
+    def __len__(self):
+        return len(self.prices)
+
+    def depth(self):
+        return int(self.cum_qtys[-1]) if len(self) > 0 else 0
+
+    def max_qty(self):
+        """Largest qty at any one price, 0 if the side is empty."""
+        if len(self) == 0:
+            return 0
+        return int(self.qtys.max()) if numpy is not None else max(self.qtys)
+
+    def levels_to_reach(self, qtys):
+        """For each of `qtys`, the index of the first level at which the
+        running total reaches it, len(self) if it never does."""
+        if numpy is not None:
+            return numpy.searchsorted(self.cum_qtys, qtys, side='left')
+        return [bisect.bisect_left(self.cum_qtys, qty) for qty in qtys]
+
+
+class OrderBookSnapshot(object):
+    """Built from an orderbook response with from_json()."""
+
+    __slots__ = ('venue', 'symbol', 'ts', 'bids', 'asks')
+
+    def __init__(self, venue, symbol, ts, bid_prices, bid_qtys, ask_prices,
+                 ask_qtys):
+        self.venue = venue
+        self.symbol = symbol
+        self.ts = ts
+        self.bids = SnapshotSide(bid_prices, bid_qtys)
+        self.asks = SnapshotSide(ask_prices, ask_qtys)
+
+    @classmethod
+    def from_json(cls, orderbook):
+        sides = []
+        for levels in (orderbook['bids'], orderbook['asks']):
+            levels = levels or []
+            sides.append(array('l', [level['price'] for level in levels]))
+            sides.append(array('l', [level['qty'] for level in levels]))
+        return cls(orderbook['venue'], orderbook['symbol'], orderbook['ts'],
+                   *sides)
+
+    def best_bid(self):
+        return int(self.bids.prices[0]) if len(self.bids) > 0 else None
+
+    def best_ask(self):
+        return int(self.asks.prices[0]) if len(self.asks) > 0 else None
+
+    def any_informed_orders(self, threshold):
+        """Whether any price on either side has more than `threshold`
+        resting."""
+        return max(self.bids.max_qty(), self.asks.max_qty()) > threshold
+
+    def price_till_qty(self, qty_marks, price_delta_fallback, are_bids):
+        """For each of `qty_marks`, the price you'd have to go to on one side
+        to trade that qty, a list of prices or None if the side or marks
+        are empty.
+
+        Each mark is counted from the best price and is taken to be at
+        least the mark before it. Each mark deeper than the whole side moves
+        the price on by another `price_delta_fallback`, away from the other
+        side."""
+        side = self.bids if are_bids else self.asks
+        if len(side) == 0 or len(qty_marks) == 0:
+            return None
+
+        price_delta_fallback = abs(price_delta_fallback)
+        if are_bids:
+            price_delta_fallback *= -1
+
+        running_marks = []
+        for qty in qty_marks:
+            running_marks.append(qty if len(running_marks) == 0
+                                 else max(qty, running_marks[-1]))
+
+        last_idx = len(side) - 1
+        depth = side.depth()
+        fallback_price = int(side.prices[last_idx])
+        prices = []
+        for qty, idx in zip(qty_marks, side.levels_to_reach(running_marks)):
+            if idx <= last_idx:
+                price = int(side.prices[idx])
+            else:
+                if qty > depth:
+                    fallback_price += price_delta_fallback
+                price = fallback_price
+            prices.append(max(price, 0))
+        return prices
+
+    def to_json(self):
+        """Back to the shape of the API's orderbook response."""
+        def levels(side, is_buy):
+            if len(side) == 0:
+                return None
+            return [{'price': int(price), 'qty': int(qty), 'isBuy': is_buy}
+                    for price, qty in zip(side.prices, side.qtys)]
+
+        return {
+            'ok': True,
+            'venue': self.venue,
+            'symbol': self.symbol,
+            'bids': levels(self.bids, True),
+            'asks': levels(self.asks, False),
+            'ts': self.ts,
+        }
+
+
+# Levels that differ between two snapshots of one side. added and removed
+# are [(price, qty)], changed is [(price, old_qty, new_qty)].
+SideDelta = collections.namedtuple('SideDelta', ['added', 'removed', 'changed'])
+
+
+class BookDelta(object):
+    """What changed from `prev` to `snapshot`, see diff_snapshots()."""
+
+    __slots__ = ('prev', 'snapshot', 'bids', 'asks')
+
+    def __init__(self, prev, snapshot, bids, asks):
+        self.prev = prev
+        self.snapshot = snapshot
+        self.bids = bids
+        self.asks = asks
+
+    def is_empty(self):
+        return not any(self.bids) and not any(self.asks)
+
+
+def _same_levels(old, new):
+    if len(old) != len(new):
+        return False
+    if numpy is not None:
+        return (numpy.array_equal(old.prices, new.prices) and
+                numpy.array_equal(old.qtys, new.qtys))
+    return old.prices == new.prices and old.qtys == new.qtys
+
+
+def _diff_side(old, new):
+    if old is None:
+        return SideDelta([(int(price), int(qty)) for price, qty
+                          in zip(new.prices, new.qtys)], [], [])
+    if _same_levels(old, new):
+        return SideDelta([], [], [])
+
+    old_levels = dict(zip(old.prices.tolist(), old.qtys.tolist()))
+    new_levels = dict(zip(new.prices.tolist(), new.qtys.tolist()))
+    added = []
+    changed = []
+    for price, qty in new_levels.items():
+        old_qty = old_levels.pop(price, None)
+        if old_qty is None:
+            added.append((price, qty))
+        elif old_qty != qty:
+            changed.append((price, old_qty, qty))
+    # Whatever is left wasn't in the new snapshot
+    removed = list(old_levels.items())
+    return SideDelta(added, removed, changed)
+
+
+def diff_snapshots(prev, snapshot):
+    """BookDelta from OrderBookSnapshot `prev` to `snapshot`. With no `prev`
+    every level in `snapshot` counts as added."""
+    return BookDelta(prev, snapshot,
+                     _diff_side(prev and prev.bids, snapshot.bids),
+                     _diff_side(prev and prev.asks, snapshot.asks))
+
+
+class BookDeltaStream(object):
+    """Diffs each snapshot pushed against the one before and hands the
+    BookDelta to every subscriber, so they can update from the levels that
+    changed rather than the whole book.
+
+        stream = BookDeltaStream()
+        stream.subscribe(detector.update)
+        stream.push(OrderBookSnapshot.from_json(purse.orderbook()))
+    """
+
+    def __init__(self):
+        self.latest = None
+        self._subscribers = []
+
+    def subscribe(self, on_delta):
+        self._subscribers.append(on_delta)
+
+    def push(self, snapshot):
+        delta = diff_snapshots(self.latest, snapshot)
+        self.latest = snapshot
+        for on_delta in self._subscribers:
+            on_delta(delta)
+        return delta
+
+
+class InformedOrderDetector(object):
+    """OrderBookSnapshot.any_informed_orders() kept up to date from
+    BookDeltas, by tracking the prices with more than `threshold`
+    resting."""
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self._informed = {'bids': set(), 'asks': set()}
+
+    def update(self, delta):
+        for name in ('bids', 'asks'):
+            side_delta = getattr(delta, name)
+            informed = self._informed[name]
+            if delta.prev is None:
+                informed.clear()
+            for price, _ in side_delta.removed:
+                informed.discard(price)
+            for price, qty in side_delta.added:
+                if qty > self.threshold:
+                    informed.add(price)
+            for price, _, qty in side_delta.changed:
+                if qty > self.threshold:
+                    informed.add(price)
+                else:
+                    informed.discard(price)
+
+    def any_informed_orders(self):
+        return any(len(informed) > 0 for informed in self._informed.values())
+
+
+class LadderPricer(object):
+    """OrderBookSnapshot.price_till_qty() for one side, only recomputed when
+    a BookDelta changes a level at or better than the deepest one the marks
+    reached. The prices are in `prices`."""
+
+    def __init__(self, qty_marks, price_delta_fallback, are_bids):
+        self.qty_marks = qty_marks
+        self.price_delta_fallback = price_delta_fallback
+        self.are_bids = are_bids
+        self.prices = None
+        self.num_recomputes = 0
+        # Price of the deepest level reached, None if the marks went past
+        # the end of the side, then every change counts
+        self._reach = None
+
+    def _touches(self, side_delta):
+        for levels in side_delta:
+            for level in levels:
+                price = level[0]
+                if (price >= self._reach) if self.are_bids else (
+                        price <= self._reach):
+                    return True
+        return False
+
+    def update(self, delta):
+        side_delta = delta.bids if self.are_bids else delta.asks
+        if (delta.prev is not None and self._reach is not None and
+                not self._touches(side_delta)):
+            return
+
+        snapshot = delta.snapshot
+        self.prices = snapshot.price_till_qty(
+            self.qty_marks, self.price_delta_fallback, self.are_bids)
+        self.num_recomputes += 1
+
+        side = snapshot.bids if self.are_bids else snapshot.asks
+        self._reach = None
+        if self.prices is not None:
+            idx = side.levels_to_reach([max(self.qty_marks)])[0]
+            if idx < len(side):
+                self._reach = int(side.prices[idx])
@@ -0,0 +1,662 @@
+"""Capture market data for one stock to a binary file of fixed-size records,
+for the backtester and for analysis.
+
+The file starts with a header the size of one record (venue, symbol,
+account and the number of records), then has one or more 80 byte records
+per message:
+
+    BOOK       an orderbook: its ts, bid and ask counts, and how many LEVELS
+               records follow
+    LEVELS     up to 7 (price, qty) pairs, bids best first then asks
+    QUOTE      a quote, from the REST API or the tickertape
+    EXECUTION  one fill of one of our orders, with a summary of the order
+
+Records are packed straight into a memory map of the file, which grows in
+chunks, so writing a message costs no system calls and only the packing.
+
+    writer = CaptureWriter('session.cap', 'TESTEX', 'FOOBAR', 'EXB123')
+    writer.orderbook(purse.orderbook())
+    writer.close()
+
+Opening a writer on an existing capture appends to it, after the records
+of its last flush(), unless it is told to overwrite it.
+
+CaptureReader maps a capture back in. Records are fixed size, so it reads
+the ts of every `index_every`th one into a sparse index without scanning
+the rest, and seek(ts) is a binary search of that index then a short scan.
+The messages it yields are views that unpack fields from the map as they
+are read, copying nothing up front.
+
+    reader = CaptureReader('session.cap')
+    for book in reader.messages(start_ts, end_ts, kinds=(BOOK,)):
+        print(book.ts, book.bids[0])
+"""
+
+from __future__ import print_function
+
+import bisect
+import datetime
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+from booksnapshot import OrderBookSnapshot
+from lib import parse_ts
+from livebook import FeedClient
+
+
+MAGIC = b'SFCAP\x00\x00\x01'
+VERSION = 1
+
+# magic, version, record size, reserved, venue, symbol, account,
+# number of records, created
+HEADER = struct.Struct('<8sHHI16s16s16sQd')
+# kind, flags, count, sequence number, ts, second ts, 14 ints
+RECORD = struct.Struct('<BBHIdd14i')
+RECORD_SIZE = RECORD.size
+assert HEADER.size == RECORD_SIZE
+
+BOOK = 1
+LEVELS = 2
+QUOTE = 3
+EXECUTION = 4
+
+PAIRS_PER_LEVELS = 7
+
+# QUOTE flags
+HAS_BID = 1
+HAS_ASK = 2
+HAS_LAST = 4
+TICKERTAPE = 8
+
+# EXECUTION flags
+BUY = 1
+STANDING_COMPLETE = 2
+INCOMING_COMPLETE = 4
+ORDER_OPEN = 8
+
+ORDER_TYPES = ('limit', 'market', 'fill-or-kill', 'immediate-or-cancel')
+
+_NO_INTS = (0,) * 14
+
+# Where fields sit within a record, for views to unpack them one at a time
+_TS_OFFSET = 8
+_TS2_OFFSET = 16
+_INTS_OFFSET = 24
+_INT = struct.Struct('<i')
+_PAIR = struct.Struct('<ii')
+_DOUBLE = struct.Struct('<d')
+
+
+def _ts_or_zero(ts):
+    return parse_ts(ts) if ts else 0.0
+
+
+def format_ts(secs):
+    """A venue timestamp for seconds since the epoch, the reverse of
+    parse_ts()."""
+    return datetime.datetime.utcfromtimestamp(secs).strftime(
+        '%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+class CaptureWriter(object):
+    """Appends records to a capture file. Safe to write from several
+    threads. Readers see records up to the last flush() or close(), and
+    writes after close() are dropped.
+
+    An existing file must be a capture of the same stock, and is appended
+    to after the records counted at its last flush(). With `overwrite` it
+    is started afresh instead."""
+
+    def __init__(self, path, venue, symbol, account='', chunk_records=65536,
+                 overwrite=False):
+        self._lock = threading.Lock()
+        self._chunk_bytes = chunk_records * RECORD_SIZE
+        self._venue = venue
+        self._symbol = symbol
+        self._account = account
+        self._map = None
+        self.num_records = 0
+        self._created = time.time()
+        flags = os.O_RDWR | os.O_CREAT
+        if overwrite:
+            flags |= os.O_TRUNC
+        self._fd = os.open(path, flags)
+        try:
+            if os.fstat(self._fd).st_size > 0:
+                self._resume(path)
+        except ValueError:
+            os.close(self._fd)
+            raise
+        self._offset = (1 + self.num_records) * RECORD_SIZE
+        self._size = self._offset + self._chunk_bytes
+        os.ftruncate(self._fd, self._size)
+        self._map = mmap.mmap(self._fd, self._size)
+        self._write_header()
+
+    def _resume(self, path):
+        """Carry on after the records in `path`'s header."""
+        header = os.read(self._fd, RECORD_SIZE)
+        if len(header) < RECORD_SIZE:
+            raise ValueError('{} is not a version {} capture'.format(
+                path, VERSION))
+        (magic, version, record_size, _, venue, symbol, _, num_records,
+         created) = HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION or record_size != RECORD_SIZE:
+            raise ValueError('{} is not a version {} capture'.format(
+                path, VERSION))
+        venue = venue.rstrip(b'\x00').decode('utf-8')
+        symbol = symbol.rstrip(b'\x00').decode('utf-8')
+        if (venue, symbol) != (self._venue, self._symbol):
+            raise ValueError('{} is a capture of {} {}, not {} {}'.format(
+                path, venue, symbol, self._venue, self._symbol))
+        # Anything past the count was never flushed, and is written over
+        self.num_records = min(
+            num_records, os.fstat(self._fd).st_size // RECORD_SIZE - 1)
+        self._created = created
+
+    def _write_header(self):
+        HEADER.pack_into(
+            self._map, 0, MAGIC, VERSION, RECORD_SIZE, 0,
+            self._venue.encode('utf-8'), self._symbol.encode('utf-8'),
+            self._account.encode('utf-8'), self.num_records, self._created)
+
+    def _reserve(self, num_records):
+        """Offset to pack `num_records` records at, growing the file if
+        they don't fit. Must hold the lock."""
+        needed = self._offset + num_records * RECORD_SIZE
+        if needed > self._size:
+            self._map.flush()
+            self._map.close()
+            self._size = max(needed, self._size + self._chunk_bytes)
+            os.ftruncate(self._fd, self._size)
+            self._map = mmap.mmap(self._fd, self._size)
+        offset = self._offset
+        self._offset = needed
+        return offset
+
+    def _pack(self, offset, kind, flags, count, ts, ts2, ints):
+        RECORD.pack_into(self._map, offset, kind, flags, count,
+                         self.num_records & 0xffffffff, ts, ts2, *ints)
+        self.num_records += 1
+
+    def orderbook(self, orderbook):
+        """Record an orderbook response."""
+        bids = orderbook['bids'] or []
+        asks = orderbook['asks'] or []
+        num_levels = len(bids) + len(asks)
+        num_levels_records = -(-num_levels // PAIRS_PER_LEVELS)
+        ts = parse_ts(orderbook['ts'])
+
+        with self._lock:
+            if self._map is None:
+                return
+            offset = self._reserve(1 + num_levels_records)
+            self._pack(offset, BOOK, 0, num_levels_records, ts, 0.0,
+                       (len(bids), len(asks)) + _NO_INTS[2:])
+
+            pairs = []
+            for level in bids:
+                pairs.extend((level['price'], level['qty']))
+            for level in asks:
+                pairs.extend((level['price'], level['qty']))
+            pairs.extend(_NO_INTS)
+            for idx in range(num_levels_records):
+                offset += RECORD_SIZE
+                start = idx * 2 * PAIRS_PER_LEVELS
+                count = min(PAIRS_PER_LEVELS,
+                            num_levels - idx * PAIRS_PER_LEVELS)
+                self._pack(offset, LEVELS, 0, count, ts, 0.0,
+                           pairs[start:start + 2 * PAIRS_PER_LEVELS])
+
+    def quote(self, quote, tickertape=False):
+        """Record a quote, or a tickertape message's quote with
+        `tickertape`."""
+        flags = TICKERTAPE if tickertape else 0
+        if 'bid' in quote:
+            flags |= HAS_BID
+        if 'ask' in quote:
+            flags |= HAS_ASK
+        if 'last' in quote:
+            flags |= HAS_LAST
+        ints = (quote.get('bid', 0), quote.get('ask', 0),
+                quote.get('bidSize', 0), quote.get('askSize', 0),
+                quote.get('bidDepth', 0), quote.get('askDepth', 0),
+                quote.get('last', 0), quote.get('lastSize', 0)) + _NO_INTS[8:]
+        ts = _ts_or_zero(quote.get('quoteTime'))
+        last_trade = _ts_or_zero(quote.get('lastTrade'))
+
+        with self._lock:
+            if self._map is None:
+                return
+            self._pack(self._reserve(1), QUOTE, flags, 0, ts, last_trade, ints)
+
+    def tickertape(self, message):
+        if message.get('ok'):
+            self.quote(message['quote'], tickertape=True)
+
+    def execution(self, message):
+        """Record an executions websocket message."""
+        if not message.get('ok'):
+            return
+        order = message['order']
+        flags = BUY if order['direction'] == 'buy' else 0
+        if message['standingComplete']:
+            flags |= STANDING_COMPLETE
+        if message['incomingComplete']:
+            flags |= INCOMING_COMPLETE
+        if order['open']:
+            flags |= ORDER_OPEN
+        ints = (order['id'], message['standingId'], message['incomingId'],
+                message['price'], message['filled'], order['price'],
+                order['originalQty'], order['qty'], order['totalFilled'],
+                len(order['fills']), ORDER_TYPES.index(order['orderType']),
+                0, 0, 0)
+        ts = parse_ts(message['filledAt'])
+        order_ts = parse_ts(order['ts'])
+
+        with self._lock:
+            if self._map is None:
+                return
+            self._pack(self._reserve(1), EXECUTION, flags, 0, ts, order_ts,
+                       ints)
+
+    def flush(self):
+        """Make everything written so far visible to readers."""
+        with self._lock:
+            if self._map is None:
+                return
+            self._write_header()
+            self._map.flush()
+
+    def close(self):
+        with self._lock:
+            if self._map is None:
+                return
+            self._write_header()
+            self._map.flush()
+            self._map.close()
+            self._map = None
+            # Drop the unused end of the last chunk
+            os.ftruncate(self._fd, self._offset)
+            os.close(self._fd)
+
+
+class _RecordView(object):
+    """One record of a CaptureReader's map, valid until the reader is
+    closed."""
+
+    __slots__ = ('_map', '_offset', 'position')
+
+    def __init__(self, buf, offset, position):
+        self._map = buf
+        self._offset = offset
+        self.position = position
+
+    def _int(self, idx):
+        return _INT.unpack_from(
+            self._map, self._offset + _INTS_OFFSET + 4 * idx)[0]
+
+    def _flags(self):
+        return ord(self._map[self._offset + 1:self._offset + 2])
+
+    @property
+    def ts(self):
+        return _DOUBLE.unpack_from(self._map, self._offset + _TS_OFFSET)[0]
+
+    @property
+    def ts2(self):
+        return _DOUBLE.unpack_from(self._map, self._offset + _TS2_OFFSET)[0]
+
+
+class LevelsView(object):
+    """One side of a BookView, a sequence of (price, qty) best first,
+    unpacked from the LEVELS records as they are indexed."""
+
+    __slots__ = ('_map', '_offset', '_start', '_len')
+
+    def __init__(self, buf, book_offset, start, length):
+        self._map = buf
+        # The first LEVELS record follows the BOOK record
+        self._offset = book_offset + RECORD_SIZE
+        self._start = start
+        self._len = length
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += self._len
+        if not 0 <= idx < self._len:
+            raise IndexError('level out of range')
+        record, pair = divmod(self._start + idx, PAIRS_PER_LEVELS)
+        return _PAIR.unpack_from(
+            self._map, self._offset + record * RECORD_SIZE + _INTS_OFFSET +
+            8 * pair)
+
+    def __iter__(self):
+        for idx in range(self._len):
+            yield self[idx]
+
+    def prices(self):
+        return [price for price, _ in self]
+
+    def qtys(self):
+        return [qty for _, qty in self]
+
+
+class BookView(_RecordView):
+    kind = 'orderbook'
+    __slots__ = ()
+
+    @property
+    def bids(self):
+        return LevelsView(self._map, self._offset, 0, self._int(0))
+
+    @property
+    def asks(self):
+        num_bids = self._int(0)
+        return LevelsView(self._map, self._offset, num_bids, self._int(1))
+
+    def to_snapshot(self, venue, symbol):
+        bids, asks = self.bids, self.asks
+        return OrderBookSnapshot(venue, symbol, format_ts(self.ts),
+                                 bids.prices(), bids.qtys(), asks.prices(),
+                                 asks.qtys())
+
+    def to_json(self, venue, symbol):
+        """In the shape of the API's orderbook response."""
+        def levels(side, is_buy):
+            if len(side) == 0:
+                return None
+            return [{'price': price, 'qty': qty, 'isBuy': is_buy}
+                    for price, qty in side]
+
+        return {
+            'ok': True,
+            'venue': venue,
+            'symbol': symbol,
+            'bids': levels(self.bids, True),
+            'asks': levels(self.asks, False),
+            'ts': format_ts(self.ts),
+        }
+
+
+class QuoteView(_RecordView):
+    kind = 'quote'
+    __slots__ = ()
+
+    @property
+    def from_tickertape(self):
+        return bool(self._flags() & TICKERTAPE)
+
+    def to_json(self, venue, symbol):
+        """In the shape of the API's quote response."""
+        flags = self._flags()
+        ints = RECORD.unpack_from(self._map, self._offset)[6:]
+        quote = {'ok': True, 'venue': venue, 'symbol': symbol,
+                 'bidSize': ints[2], 'askSize': ints[3],
+                 'bidDepth': ints[4], 'askDepth': ints[5]}
+        if flags & HAS_BID:
+            quote['bid'] = ints[0]
+        if flags & HAS_ASK:
+            quote['ask'] = ints[1]
+        if flags & HAS_LAST:
+            quote['last'] = ints[6]
+            quote['lastSize'] = ints[7]
+        if self.ts:
+            quote['quoteTime'] = format_ts(self.ts)
+        if self.ts2:
+            quote['lastTrade'] = format_ts(self.ts2)
+        return quote
+
+
+class FillView(_RecordView):
+    """One fill of one of our orders, from an EXECUTION record."""
+
+    kind = 'execution'
+    __slots__ = ()
+
+    @property
+    def order_id(self):
+        return self._int(0)
+
+    @property
+    def is_buy(self):
+        return bool(self._flags() & BUY)
+
+    @property
+    def price(self):
+        return self._int(3)
+
+    @property
+    def qty(self):
+        return self._int(4)
+
+    @property
+    def order_open(self):
+        return bool(self._flags() & ORDER_OPEN)
+
+    @property
+    def total_filled(self):
+        return self._int(8)
+
+    def to_json(self, venue, symbol, account=''):
+        """In the shape of an executions websocket message, less the
+        order's fills, which the capture doesn't keep."""
+        flags = self._flags()
+        ints = RECORD.unpack_from(self._map, self._offset)[6:]
+        return {
+            'ok': True,
+            'account': account,
+            'venue': venue,
+            'symbol': symbol,
+            'order': {
+                'ok': True, 'symbol': symbol, 'venue': venue,
+                'direction': 'buy' if flags & BUY else 'sell',
+                'originalQty': ints[6], 'qty': ints[7], 'price': ints[5],
+                'orderType': ORDER_TYPES[ints[10]], 'id': ints[0],
+                'account': account, 'ts': format_ts(self.ts2), 'fills': [],
+                'totalFilled': ints[8], 'open': bool(flags & ORDER_OPEN),
+            },
+            'standingId': ints[1],
+            'incomingId': ints[2],
+            'price': ints[3],
+            'filled': ints[4],
+            'filledAt': format_ts(self.ts),
+            'standingComplete': bool(flags & STANDING_COMPLETE),
+            'incomingComplete': bool(flags & INCOMING_COMPLETE),
+        }
+
+
+_VIEWS = {BOOK: BookView, QUOTE: QuoteView, EXECUTION: FillView}
+
+
+class CaptureReader(object):
+    """Reads a capture file written by CaptureWriter, which may still be
+    being written, up to its last flush().
+
+    Positions are record numbers. seek(ts) goes to the first message
+    stamped at or after `ts`, taking the records to be in time order, as
+    they are give or take a message from another feed arriving late. Views
+    from messages() read the map directly, so are only good until close()."""
+
+    def __init__(self, path, index_every=4096):
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, record_size, _, venue, symbol, account,
+         num_records, created) = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION or record_size != RECORD_SIZE:
+            self.close()
+            raise ValueError('{} is not a version {} capture'.format(
+                path, VERSION))
+        self.venue = venue.rstrip(b'\x00').decode('utf-8')
+        self.symbol = symbol.rstrip(b'\x00').decode('utf-8')
+        self.account = account.rstrip(b'\x00').decode('utf-8')
+        self.created = created
+        self.num_records = min(num_records,
+                               len(self._map) // RECORD_SIZE - 1)
+        self._index_every = index_every
+        self._index_ts, self._index_positions = self._build_index()
+        self._position = 0
+
+    def _offset(self, position):
+        return (position + 1) * RECORD_SIZE
+
+    def _kind(self, position):
+        return ord(self._map[self._offset(position):
+                             self._offset(position) + 1])
+
+    def _ts(self, position):
+        return _DOUBLE.unpack_from(
+            self._map, self._offset(position) + _TS_OFFSET)[0]
+
+    def _build_index(self):
+        """The ts of every `index_every`th record, kept non-decreasing so it
+        can be binary searched, and their positions. Quotes without a
+        quoteTime have no ts, so the next record stamped stands in."""
+        index_ts = []
+        positions = []
+        latest = 0.0
+        for position in range(0, self.num_records, self._index_every):
+            end = min(position + self._index_every, self.num_records)
+            while position < end and self._ts(position) == 0.0:
+                position += 1
+            if position == end:
+                continue
+            latest = max(latest, self._ts(position))
+            index_ts.append(latest)
+            positions.append(position)
+        return index_ts, positions
+
+    def tell(self):
+        return self._position
+
+    def seek(self, ts):
+        """Go to the first message at or after `ts`, returns its position,
+        num_records if there is none."""
+        idx = bisect.bisect_left(self._index_ts, ts) - 1
+        position = self._index_positions[idx] if idx >= 0 else 0
+        while position < self.num_records:
+            kind = self._kind(position)
+            if kind == LEVELS:
+                # Landed in the middle of an orderbook
+                position += 1
+                continue
+            if self._ts(position) >= ts:
+                break
+            position += self._message_records(position)
+        self._position = min(position, self.num_records)
+        return self._position
+
+    def _message_records(self, position):
+        if self._kind(position) == BOOK:
+            return 1 + struct.unpack_from(
+                '<H', self._map, self._offset(position) + 2)[0]
+        return 1
+
+    def read(self):
+        """The view of the message at the current position, moving past it,
+        None at the end."""
+        while self._position < self.num_records:
+            position = self._position
+            self._position += self._message_records(position)
+            view = _VIEWS.get(self._kind(position))
+            if view is not None:
+                return view(self._map, self._offset(position), position)
+        return None
+
+    def messages(self, start_ts=None, end_ts=None, kinds=None):
+        """Yield views of the messages from `start_ts`, or the current
+        position, until one is stamped after `end_ts`. `kinds` limits them
+        to BOOK, QUOTE and/or EXECUTION."""
+        if start_ts is not None:
+            self.seek(start_ts)
+        view_types = None if kinds is None else tuple(
+            _VIEWS[kind] for kind in kinds)
+        while True:
+            view = self.read()
+            if view is None:
+                return
+            if end_ts is not None and view.ts > end_ts:
+                return
+            if view_types is None or isinstance(view, view_types):
+                yield view
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+
+def is_capture(path):
+    """Whether `path` starts like a capture file."""
+    with open(path, 'rb') as fp:
+        return fp.read(len(MAGIC)) == MAGIC
+
+
+class Recorder(object):
+    """Captures a StockPurse's stock to `path`: every tickertape message and
+    execution from the websockets, and an orderbook every `orderbook_secs`.
+
+        recorder = Recorder(purse, 'session.cap')
+        recorder.start()
+        ...
+        recorder.stop()
+    """
+
+    def __init__(self, stock_purse, path, orderbook_secs=1.0,
+                 flush_secs=1.0):
+        self._stock_purse = stock_purse
+        self._orderbook_secs = orderbook_secs
+        self._flush_secs = flush_secs
+        self.writer = CaptureWriter(path, stock_purse.venue(),
+                                    stock_purse.stock(),
+                                    stock_purse.account())
+        self._stopped = threading.Event()
+        self._feeds = []
+        self._poller = None
+
+    def start(self):
+        ws_base = self._stock_purse.ws_url_base()
+        path = '{}/{}/venues/{}/{{}}/stocks/{}'.format(
+            ws_base, self._stock_purse.account(), self._stock_purse.venue(),
+            self._stock_purse.stock())
+        self._feeds = [
+            FeedClient(path.format('tickertape'), self.writer.tickertape),
+            FeedClient(path.format('executions'), self.writer.execution),
+        ]
+        for feed in self._feeds:
+            feed.connect()
+        self._poller = threading.Thread(target=self._poll, name='Recorder')
+        self._poller.daemon = True
+        self._poller.start()
+
+    def _poll(self):
+        next_flush = time.time() + self._flush_secs
+        while not self._stopped.is_set():
+            try:
+                self.writer.orderbook(self._stock_purse.orderbook())
+            except Exception as e:
+                # Keep capturing the websockets whatever the REST API does
+                logging.warning('recorder orderbook failed: %s', e)
+            if time.time() >= next_flush:
+                self.writer.flush()
+                next_flush = time.time() + self._flush_secs
+            self._stopped.wait(self._orderbook_secs)
+
+    def stop(self):
+        self._stopped.set()
+        feeds, self._feeds = self._feeds, []
+        for feed in feeds:
+            feed.close()
+        if self._poller is not None:
+            self._poller.join()
+        # ws4py may still deliver a message after close(), the closed
+        # writer drops it
+        self.writer.close()
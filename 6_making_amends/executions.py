@@ -0,0 +1,160 @@
+from __future__ import print_function
+
+import collections
+import logging
+import threading
+
+from lib import API_URL_BASE, ws_url_base_for
+from livebook import FeedClient
+
+
+class ExecutionsConsumer:
+    """Listens to an account's executions websocket and hands each fill to
+    the StockPurse that owns the order, so positions and basis move as soon
+    as the fill happens.
+
+    Each message carries the whole state of our order, so a missed message
+    is made good by the next one for that order. To catch orders that never
+    get another message, a jump of more than one in an order's fill count
+    counts as a gap and the order is refreshed over REST. After a
+    disconnect the consumer reconnects with exponential backoff and then
+    refreshes every open order, since anything could have been missed.
+
+    Messages are parsed and routed on the websocket's thread.
+
+        consumer = ExecutionsConsumer(account, venue,
+                                      ws_url_base=purse.ws_url_base())
+        consumer.add_purse(purse)
+        consumer.start()
+    """
+
+    # Executions for orders no purse knows about yet are kept in case the
+    # order's POST response is still on its way, see claim()
+    max_unrouted = 1000
+
+    def __init__(self, account, venue, stock=None, ws_url_base=None,
+                 on_execution=None, reconnect_delay=0.5,
+                 max_reconnect_delay=30):
+        """`ws_url_base` defaults to the live venue's, pass a purse's
+        ws_url_base() to follow its `url_base`."""
+        if ws_url_base is None:
+            ws_url_base = ws_url_base_for(API_URL_BASE)
+        url = '{}/{}/venues/{}/executions'.format(ws_url_base, account, venue)
+        if stock is not None:
+            url += '/stocks/{}'.format(stock)
+        self._url = url
+        self._on_execution = on_execution
+        self._reconnect_delay = reconnect_delay
+        self._max_reconnect_delay = max_reconnect_delay
+        self._next_delay = reconnect_delay
+        self._lock = threading.Lock()
+        self._purses = []
+        self._fill_counts = {}
+        self._unrouted = collections.OrderedDict()
+        self._feed = None
+        self._running = False
+        self.num_messages = 0
+        self.num_gaps = 0
+        self.num_reconnects = 0
+
+    def add_purse(self, stock_purse):
+        stock_purse.set_execution_source(self)
+        with self._lock:
+            self._purses.append(stock_purse)
+
+    def start(self):
+        self._running = True
+        self._connect()
+
+    def stop(self):
+        self._running = False
+        if self._feed is not None:
+            self._feed.close()
+
+    def forget(self, id):
+        """Stop tracking order `id`, which its purse has closed, e.g. by a
+        cancel, which sends no execution."""
+        with self._lock:
+            self._fill_counts.pop(id, None)
+
+    def claim(self, id):
+        """Pop the latest order state received for `id` before any purse
+        owned it, or None."""
+        with self._lock:
+            return self._unrouted.pop(id, None)
+
+    def _connect(self):
+        if not self._running:
+            return
+        feed = FeedClient(self._url, self.on_message, self._on_closed)
+        try:
+            feed.connect()
+        except Exception as e:
+            logging.warning('executions connect to %s failed: %s',
+                            self._url, e)
+            self._schedule_reconnect()
+            return
+        self._feed = feed
+        if self._next_delay != self._reconnect_delay:
+            # Reconnected, catch up on whatever was missed
+            self._next_delay = self._reconnect_delay
+            for stock_purse in list(self._purses):
+                stock_purse.refresh_open_orders()
+
+    def _on_closed(self, feed):
+        if feed is self._feed and self._running:
+            self._schedule_reconnect()
+
+    def _schedule_reconnect(self):
+        self.num_reconnects += 1
+        delay = self._next_delay
+        self._next_delay = min(self._next_delay * 2, self._max_reconnect_delay)
+        logging.info('reconnecting to %s in %.1f secs', self._url, delay)
+        timer = threading.Timer(delay, self._connect)
+        timer.daemon = True
+        timer.start()
+
+    def on_message(self, message):
+        if not message.get('ok'):
+            logging.warning('executions error: %s', message.get('error'))
+            return
+        self.num_messages += 1
+        order = message['order']
+        id = order['id']
+
+        num_fills = len(order['fills'])
+        with self._lock:
+            # Fills from before we first saw an order came in its POST
+            # response, so only count gaps once the stream has seen it
+            last_num_fills = self._fill_counts.get(id)
+            gap = last_num_fills is not None and num_fills > last_num_fills + 1
+            self._fill_counts[id] = max(num_fills, last_num_fills or 0)
+            if not order['open']:
+                del self._fill_counts[id]
+
+        owner = None
+        for stock_purse in list(self._purses):
+            if stock_purse.apply_order_update(order):
+                owner = stock_purse
+                break
+
+        if owner is None:
+            with self._lock:
+                self._unrouted[id] = order
+                while len(self._unrouted) > self.max_unrouted:
+                    self._unrouted.popitem(last=False)
+            # A purse may have recorded the order since we looked
+            for stock_purse in list(self._purses):
+                if stock_purse.owns(id):
+                    early_update = self.claim(id)
+                    if early_update is not None:
+                        stock_purse.apply_order_update(early_update)
+                    break
+        elif gap:
+            self.num_gaps += 1
+            logging.warning('executions gap on order %s, had %s fills, '
+                            'message has %s', id, last_num_fills, num_fills)
+            owner.refresh(id)
+
+        if self._on_execution is not None:
+            self._on_execution(message)
@@ -0,0 +1,52 @@
+"""JSON decoding for API responses, see StockPurse's `decoder`.
+
+Uses the fastest backend installed out of orjson, ujson and the standard
+library's json.
+"""
+
+from __future__ import print_function
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+def _json_loads(data):
+    # json.loads() is quicker given text than left to decode bytes itself
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    return json.loads(data)
+
+
+def _backends():
+    backends = {'json': _json_loads}
+    if ujson is not None:
+        backends['ujson'] = ujson.loads
+    if orjson is not None:
+        backends['orjson'] = orjson.loads
+    return backends
+
+BACKENDS = _backends()
+
+# Fastest first
+DEFAULT_BACKEND = next(name for name in ('orjson', 'ujson', 'json')
+                       if name in BACKENDS)
+
+
+class Decoder:
+    """Decodes response bodies, bytes or text, with one of BACKENDS."""
+
+    def __init__(self, backend=None):
+        self.backend = DEFAULT_BACKEND if backend is None else backend
+        if self.backend not in BACKENDS:
+            raise ValueError('JSON backend {!r} is not installed, have {}'
+                             .format(self.backend, ', '.join(BACKENDS)))
+        self.loads = BACKENDS[self.backend]
@@ -0,0 +1,233 @@
+"""Latency histograms for API calls, see APISession's `latency`.
+
+LatencyHistogram buckets like HdrHistogram: linear within each power of two,
+so every value is kept to within 1% however large it is, in a fixed number
+of counters. LatencyStats holds one per endpoint and phase of a request,
+where phases are seconds from sending the request to
+
+    first_byte  the response's status line and headers arriving
+    received    the whole body arriving
+    parsed      the body being decoded, recorded by StockPurse
+
+ClockEstimator works out the one-way latency to the venue and the skew
+between its clock and ours from wall clock send and receive times.
+"""
+
+from __future__ import print_function
+
+import collections
+import threading
+import time
+from array import array
+
+try:
+    from time import monotonic
+except ImportError:
+    # Python 2
+    from time import time as monotonic
+
+
+PHASES = ('first_byte', 'received', 'parsed')
+
+
+class LatencyHistogram(object):
+    """Counts of latencies from 1 us up to `max_secs`, longer ones are
+    counted as `max_secs`."""
+
+    # 2 ** (SUB_BUCKET_BITS - 1) counters for each power of two, so each
+    # bucket is at most 1/128th of its values wide, under 1%
+    SUB_BUCKET_BITS = 8
+
+    def __init__(self, max_secs=3600):
+        self._half = 1 << (self.SUB_BUCKET_BITS - 1)
+        self._max_us = int(max_secs * 1e6)
+        self._counts = array('l', [0] * (self._index(self._max_us) + 1))
+        self.count = 0
+        self.min_secs = None
+        self.max_secs = None
+        self._total_secs = 0.0
+
+    def _index(self, us):
+        magnitude = max(0, us.bit_length() - self.SUB_BUCKET_BITS)
+        return magnitude * self._half + (us >> magnitude)
+
+    def _highest_equivalent_us(self, index):
+        if index < 2 * self._half:
+            return index
+        magnitude = index // self._half - 1
+        sub_bucket = index - magnitude * self._half
+        return ((sub_bucket + 1) << magnitude) - 1
+
+    def record(self, secs):
+        us = min(max(int(secs * 1e6), 0), self._max_us)
+        self._counts[self._index(us)] += 1
+        self.count += 1
+        self._total_secs += secs
+        if self.min_secs is None or secs < self.min_secs:
+            self.min_secs = secs
+        if self.max_secs is None or secs > self.max_secs:
+            self.max_secs = secs
+
+    def mean(self):
+        return self._total_secs / self.count if self.count > 0 else None
+
+    def percentile(self, pct):
+        """Seconds that `pct` percent of latencies were at or below, None if
+        nothing has been recorded."""
+        if self.count == 0:
+            return None
+        target = max(1, int(round(self.count * pct / 100.0)))
+        seen = 0
+        for index, count in enumerate(self._counts):
+            seen += count
+            if seen >= target:
+                return min(self._highest_equivalent_us(index) / 1e6,
+                           self.max_secs)
+        return self.max_secs
+
+
+class RequestTiming(object):
+    """Monotonic times for one request, attached to its response as
+    `timing`, plus the wall clock times it was sent and received for
+    ClockEstimator. Started as the request leaves the client, after any
+    wait in a throttle or connection queue."""
+
+    __slots__ = ('stats', 'endpoint', 'sent', 'first_byte', 'received',
+                 'sent_wall', 'received_wall')
+
+    def __init__(self, stats, endpoint):
+        self.stats = stats
+        self.endpoint = endpoint
+        self.sent_wall = time.time()
+        self.sent = monotonic()
+        self.first_byte = None
+        self.received = None
+        self.received_wall = None
+
+    def got_first_byte(self):
+        self.first_byte = monotonic()
+        self.stats.record(self.endpoint, 'first_byte',
+                          self.first_byte - self.sent)
+
+    def got_body(self):
+        self.received = monotonic()
+        self.received_wall = time.time()
+        self.stats.record(self.endpoint, 'received', self.received - self.sent)
+
+    def parsed(self):
+        self.stats.record(self.endpoint, 'parsed', monotonic() - self.sent)
+
+
+class LatencyStats(object):
+    """A LatencyHistogram per endpoint and phase. Safe to record into from
+    several threads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+
+    def start(self, endpoint):
+        """Call just before sending a request to `endpoint`."""
+        return RequestTiming(self, endpoint)
+
+    def record(self, endpoint, phase, secs):
+        with self._lock:
+            histogram = self._histograms.get((endpoint, phase))
+            if histogram is None:
+                histogram = self._histograms[(endpoint, phase)] = \
+                    LatencyHistogram()
+            histogram.record(secs)
+
+    def histogram(self, endpoint, phase):
+        """The LatencyHistogram, or None if nothing was recorded."""
+        return self._histograms.get((endpoint, phase))
+
+    def report(self):
+        """A table of p50, p99 and max for each endpoint and phase, in
+        milliseconds."""
+        def ms(secs):
+            return '{:>9.3f}'.format(1000 * secs)
+
+        lines = ['{:<14} {:<10} {:>7} {:>9} {:>9} {:>9}'.format(
+            'endpoint', 'phase', 'n', 'p50 ms', 'p99 ms', 'max ms')]
+        with self._lock:
+            endpoints = sorted(set(
+                endpoint for endpoint, _ in self._histograms))
+            for endpoint in endpoints:
+                for phase in PHASES:
+                    histogram = self._histograms.get((endpoint, phase))
+                    if histogram is None:
+                        continue
+                    lines.append('{:<14} {:<10} {:>7} {} {} {}'.format(
+                        endpoint, phase, histogram.count,
+                        ms(histogram.percentile(50)),
+                        ms(histogram.percentile(99)), ms(histogram.max_secs)))
+        return '\n'.join(lines)
+
+
+def _median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2 == 1:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.0
+
+
+class ClockEstimator(object):
+    """Rolling estimates, over the last `window` requests, of the round trip
+    to the venue and of how far the venue's clock is ahead of ours.
+
+    Each sample is the wall clock time a request was sent and its response
+    received, plus the venue's timestamp for it if it has one. Taking the
+    venue to have stamped it halfway through the round trip, the skew is
+    that timestamp less the midpoint, and the one-way latency half the
+    round trip.
+
+    Requests sent together queue behind each other at the venue, which
+    stretches their round trips and moves their midpoints, so as NTP does
+    the one-way latency and skew come from the quickest `fastest_share` of
+    the samples only. Medians keep the odd outlier among those from moving
+    them."""
+
+    def __init__(self, window=100, fastest_share=0.1):
+        # (round trip, skew or None) per request
+        self._samples = collections.deque(maxlen=window)
+        self._fastest_share = fastest_share
+        self._lock = threading.Lock()
+
+    def add(self, sent, received, server_time=None):
+        skew = None
+        if server_time is not None:
+            skew = server_time - (sent + received) / 2.0
+        with self._lock:
+            self._samples.append((received - sent, skew))
+
+    def round_trip(self):
+        """Median seconds from send to receive, None before any samples."""
+        with self._lock:
+            if len(self._samples) == 0:
+                return None
+            return _median([round_trip for round_trip, _ in self._samples])
+
+    def _fastest(self, samples):
+        samples = sorted(samples)
+        return samples[:max(1, int(len(samples) * self._fastest_share))]
+
+    def one_way_latency(self):
+        """Half the median of the quickest round trips, None before any
+        samples."""
+        with self._lock:
+            if len(self._samples) == 0:
+                return None
+            fastest = self._fastest(self._samples)
+        return _median([round_trip for round_trip, _ in fastest]) / 2.0
+
+    def clock_skew(self):
+        """Median seconds the venue's clock is ahead of ours over the
+        quickest samples with a venue timestamp, None before any."""
+        with self._lock:
+            samples = [sample for sample in self._samples
+                       if sample[1] is not None]
+        if len(samples) == 0:
+            return None
+        return _median([skew for _, skew in self._fastest(samples)])
@@ -3,6 +3,34 @@ from __future__ import print_function
 import logging
 import requests
 import json
+import calendar
+import collections
+import threading
+import time
+from array import array
+
+try:
+    import queue
+except ImportError:
+    # Python 2
+    import Queue as queue
+
+try:
+    from time import monotonic
+except ImportError:
+    # Python 2
+    from time import time as monotonic
+
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient, HTTPError
+from tornado.ioloop import IOLoop
+from tornado.locks import Semaphore
+
+from jsondecode import Decoder
+from latency import ClockEstimator, LatencyStats
+from orderarchive import OrderArchive
+from throttle import ENDPOINT_BUDGETS, Throttle
+from tornadoclient import PipeliningHTTPClient
 
 def get_auth_key():
     with open('../AUTH_KEY') as fp:
@@ -14,6 +42,39 @@ AUTH_HEADER = {
         get_auth_key()
 }
 
+# Pass a venue_sim.py server's as StockPurse's `url_base` to trade offline,
+# websocket URLs follow from it, see ws_url_base_for()
+API_URL_BASE = 'https://api.stockfighter.io/ob/api'
+
+
+def ws_url_base_for(url_base):
+    """The websocket URL base that goes with the REST `url_base`."""
+    return (url_base.replace('https://', 'wss://', 1)
+            .replace('http://', 'ws://', 1) + '/ws')
+
+
+def parse_ts(ts):
+    """Seconds since the epoch for a venue timestamp such as
+    '2015-12-04T09:02:16.680986205Z'."""
+    # Slicing rather than strptime, this runs for every fill
+    secs = calendar.timegm((
+        int(ts[0:4]), int(ts[5:7]), int(ts[8:10]),
+        int(ts[11:13]), int(ts[14:16]), int(ts[17:19])))
+    frac = ts[20:].rstrip('Z')
+    if frac:
+        secs += float('0.' + frac)
+    return secs
+
+
+def wall_times(resp, sent_time, received_time):
+    """Wall clock times `resp` was sent and received, from its `timing` if
+    it has one, which leaves out any time the request queued in the client.
+    Otherwise `sent_time` and `received_time`."""
+    timing = getattr(resp, 'timing', None)
+    if timing is None or timing.received_wall is None:
+        return sent_time, received_time
+    return timing.sent_wall, timing.received_wall
+
 
 class APIResponseError(Exception):
     def __init__(self, status_code, error_msg=None):
@@ -22,19 +83,46 @@ class APIResponseError(Exception):
 
 
 class APISession:
-    def __init__(self):
+    """Every request is timed into `latency`, a latency.LatencyStats, and
+    its response gets a `timing` attribute for StockPurse to record the
+    parse.
+
+    Requests wait their turn in `throttle`, a throttle.Throttle, so they
+    keep under the venue's rate limits rather than being rejected by it."""
+
+    def __init__(self, url_base=API_URL_BASE, latency=None, throttle=None):
         self._session = requests.Session()
-        self._https_url_base = 'https://api.stockfighter.io/ob/api'
+        self._https_url_base = url_base
+        self.latency = LatencyStats() if latency is None else latency
+        self.throttle = Throttle() if throttle is None else throttle
+
+    def _request(self, endpoint, method, url, **kwargs):
+        budget = ENDPOINT_BUDGETS[endpoint]
+        self.throttle.acquire(budget)
+        timing = self.latency.start(endpoint)
+        try:
+            # Streamed, so the call returns once the headers are in
+            resp = self._session.request(method, url, stream=True, **kwargs)
+        except requests.RequestException:
+            self.throttle.record(budget, None)
+            raise
+        timing.got_first_byte()
+        self.throttle.record(budget, resp.status_code,
+                             resp.headers.get('Retry-After'))
+        resp.content
+        timing.got_body()
+        resp.timing = timing
+        return resp
 
     def quote(self, venue, stock):
         url = ('{}/venues/{}/stocks/{}/quote'
                .format(self._https_url_base, venue, stock))
-        return self._session.get(url)
+        return self._request('quote', 'GET', url)
 
     def orderbook(self, venue, stock):
         url = ('{}/venues/{}/stocks/{}'
                .format(self._https_url_base, venue, stock))
-        return self._session.get(url)
+        return self._request('orderbook', 'GET', url)
 
     def buy(self, venue, stock, account, type, qty, price=None):
         return self.order(venue, stock, account, type, qty, 'buy', price)
@@ -56,7 +144,8 @@ class APISession:
         if price is not None:
             body['price'] = price
 
-        resp = self._session.post(url, json=body, headers=AUTH_HEADER)
+        resp = self._request('order', 'POST', url, json=body,
+                             headers=AUTH_HEADER)
 
         logging.debug(resp.text)
 
@@ -65,12 +154,169 @@ class APISession:
     def cancel_order(self, venue, stock, order):
         url = ('{}/venues/{}/stocks/{}/orders/{}'
                .format(self._https_url_base, venue, stock, order))
-        return self._session.delete(url, headers=AUTH_HEADER)
+        return self._request('cancel', 'DELETE', url, headers=AUTH_HEADER)
+
+    def order_status(self, venue, stock, order):
+        url = ('{}/venues/{}/stocks/{}/orders/{}'
+               .format(self._https_url_base, venue, stock, order))
+        return self._request('order_status', 'GET', url, headers=AUTH_HEADER)
+
+
+class AsyncResponse:
+    """Give a tornado HTTPResponse the bits of the requests.Response
+    interface that StockPurse uses."""
+
+    def __init__(self, tornado_resp):
+        self.status_code = tornado_resp.code
+        self.content = tornado_resp.body or b''
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class AsyncAPISession:
+    """Same methods as APISession, but each returns a Future that resolves
+    to an AsyncResponse. At most `max_connections` requests are in flight at
+    once, the rest queue up inside the client.
+
+    With `pipelining`, every request is instead written back-to-back on a
+    single kept-alive connection, see PipeliningHTTPClient.
+
+    Requests are timed into `latency` and throttled by `throttle` as in
+    APISession.
+
+    Must be constructed while the IOLoop it will run on is current."""
+
+    def __init__(self, max_connections=10, pipelining=False,
+                 url_base=API_URL_BASE, latency=None, throttle=None):
+        self._https_url_base = url_base
+        self.latency = LatencyStats() if latency is None else latency
+        self.throttle = Throttle() if throttle is None else throttle
+        # Requests queue for a connection here rather than inside the
+        # client, so their timing starts once they can actually go
+        self._connections = None
+        if pipelining:
+            self._client = PipeliningHTTPClient.for_url(self._https_url_base)
+        else:
+            self._client = AsyncHTTPClient(
+                force_instance=True, max_clients=max_connections)
+            self._connections = Semaphore(max_connections)
+
+    @gen.coroutine
+    def _fetch(self, endpoint, url, method='GET', body=None, headers=None):
+        budget = ENDPOINT_BUDGETS[endpoint]
+        wait = self.throttle.reserve(budget)
+        if wait > 0:
+            yield gen.sleep(wait)
+        if self._connections is not None:
+            yield self._connections.acquire()
+        try:
+            timing = self.latency.start(endpoint)
+
+            def on_header_line(line):
+                if timing.first_byte is None:
+                    timing.got_first_byte()
+
+            resp = yield self._client.fetch(
+                url, method=method, body=body, headers=headers,
+                raise_error=False, header_callback=on_header_line)
+        finally:
+            if self._connections is not None:
+                self._connections.release()
+        # 599 is tornado's code for no response at all
+        if resp.code != 599:
+            timing.got_body()
+            self.throttle.record(budget, resp.code,
+                                 resp.headers.get('Retry-After'))
+        else:
+            self.throttle.record(budget, None)
+        resp = AsyncResponse(resp)
+        resp.timing = timing
+        raise gen.Return(resp)
+
+    def quote(self, venue, stock):
+        url = ('{}/venues/{}/stocks/{}/quote'
+               .format(self._https_url_base, venue, stock))
+        return self._fetch('quote', url)
+
+    def orderbook(self, venue, stock):
+        url = ('{}/venues/{}/stocks/{}'
+               .format(self._https_url_base, venue, stock))
+        return self._fetch('orderbook', url)
+
+    def buy(self, venue, stock, account, type, qty, price=None):
+        return self.order(venue, stock, account, type, qty, 'buy', price)
+
+    def sell(self, venue, stock, account, type, qty, price=None):
+        return self.order(venue, stock, account, type, qty, 'sell', price)
+
+    @gen.coroutine
+    def order(self, venue, stock, account, type, qty, direction, price=None):
+        url = ('{}/venues/{}/stocks/{}/orders'
+               .format(self._https_url_base, venue, stock))
+        body = {
+            'account': account,
+            'venue': venue,
+            'stock': stock,
+            'qty': qty,
+            'direction': direction,
+            'orderType': type,
+        }
+        if price is not None:
+            body['price'] = price
+
+        headers = dict(AUTH_HEADER)
+        headers['Content-Type'] = 'application/json'
+        resp = yield self._fetch(
+            'order', url, method='POST', body=json.dumps(body),
+            headers=headers)
+
+        logging.debug(resp.text)
+
+        raise gen.Return(resp)
+
+    def cancel_order(self, venue, stock, order):
+        url = ('{}/venues/{}/stocks/{}/orders/{}'
+               .format(self._https_url_base, venue, stock, order))
+        return self._fetch('cancel', url, method='DELETE', headers=AUTH_HEADER)
 
 
 class StockPurse:
-    def __init__(self, venue, stock, account, position=0, basis=0):
-        self._session = APISession()
+    def __init__(self, venue, stock, account, position=0, basis=0,
+                 pipelining=False, url_base=API_URL_BASE, session=None,
+                 async_session=None, max_closed_orders=None,
+                 archive_path=None, validator=None, decoder=None):
+        """`session` and `async_session` replace the APISession and
+        AsyncAPISession, e.g. with the simulated ones in backtest.py.
+
+        With `max_closed_orders`, only that many of the most recently closed
+        orders are kept in memory. Older ones are written to an OrderArchive
+        at `archive_path`, a temporary file if not given, and read back when
+        looked up, see get_order().
+
+        `validator` is the ResponseValidator for order responses, by default
+        each is checked in full as it arrives. `decoder` is the
+        jsondecode.Decoder for response bodies, by default the fastest
+        installed."""
+        self._session = APISession(url_base) if session is None else session
+        # Shared with the session if it times its requests, see
+        # latency.LatencyStats.report()
+        self.latency = getattr(self._session, 'latency', None)
+        if self.latency is None:
+            self.latency = LatencyStats()
+        # Likewise, so the async session spends from the same budgets
+        self.throttle = getattr(self._session, 'throttle', None)
+        # From the send and receive times of orders and cancels
+        self._clock = ClockEstimator()
+        self._url_base = url_base
+        # Created lazily if not given, see run_async()
+        self._io_loop = None
+        self._async_session = async_session
+        self._pipelining = pipelining
         self._venue = venue
         self._stock = stock
         self._account = account
@@ -82,6 +328,24 @@ class StockPurse:
         self._closed_asks = set()
         self._open_bids = set()
         self._closed_bids = set()
+        # Closed order ids in the order they closed, oldest first, only kept
+        # with `max_closed_orders`
+        self._closed_ids = collections.deque()
+        self._max_closed_orders = max_closed_orders
+        self._archive = None
+        if max_closed_orders is not None:
+            self._archive = OrderArchive(archive_path)
+        # Running totals over the open orders, see _track_resting()
+        self._open_bid_qty = 0
+        self._open_ask_qty = 0
+        self._open_bid_notional = 0
+        self._open_ask_notional = 0
+        self._last_cancel_all_secs = None
+        # Fills can also arrive on an executions consumer's thread
+        self._lock = threading.RLock()
+        self._execution_source = None
+        self._validator = validator
+        self._decoder = Decoder() if decoder is None else decoder
 
 
     def __str__(self):
@@ -102,6 +366,18 @@ class StockPurse:
             ret = self._basis + (self._last_fill_price * self._position)
         return ret
 
+    def venue(self):
+        return self._venue
+
+    def stock(self):
+        return self._stock
+
+    def account(self):
+        return self._account
+
+    def ws_url_base(self):
+        return ws_url_base_for(self._url_base)
+
     def basis(self):
         return self._basis
 
@@ -109,62 +385,235 @@ class StockPurse:
         return self._position
 
     def position_with_open_asks(self):
-        open_ask_qty = sum(
-            self._orders[id].qty_resting() for id in self._open_asks)
-        return self.position() - open_ask_qty
+        return self.position() - self._open_ask_qty
 
     def position_with_open_bids(self):
-        open_bid_qty = sum(
-            self._orders[id].qty_resting() for id in self._open_bids)
-        return self.position() + open_bid_qty
+        return self.position() + self._open_bid_qty
+
+    def open_ask_qty(self):
+        return self._open_ask_qty
+
+    def open_bid_qty(self):
+        return self._open_bid_qty
+
+    def open_ask_notional(self):
+        """Sum of price * resting qty over the open asks."""
+        return self._open_ask_notional
+
+    def open_bid_notional(self):
+        """Sum of price * resting qty over the open bids."""
+        return self._open_bid_notional
+
+    def _track_resting(self, order, sign):
+        """Add (`sign` 1) or take away (`sign` -1) `order`'s resting qty
+        from the open order totals. Closed orders have nothing resting."""
+        if not order.is_open():
+            return
+        qty = sign * order.qty_resting()
+        if order.is_ask():
+            self._open_ask_qty += qty
+            self._open_ask_notional += qty * order.price
+        else:
+            self._open_bid_qty += qty
+            self._open_bid_notional += qty * order.price
+
+    def get_order(self, id):
+        """Order `id`, from memory or the archive. KeyError if it isn't
+        ours."""
+        with self._lock:
+            order = self._orders.get(id)
+            if order is not None:
+                return order
+            record = self._archive.get(id) if self._archive else None
+        if record is None:
+            raise KeyError(id)
+        return Order.from_record(record)
+
+    def num_archived_orders(self):
+        return 0 if self._archive is None else len(self._archive)
 
     def qty_filled(self, id):
-        return self._orders[id].qty_filled()
+        return self.get_order(id).qty_filled()
 
     def _check_resp_ok_and_jsonify(self, resp):
         if resp.status_code != 200:
             raise APIResponseError(resp.status_code)
 
-        resp_json = resp.json()
+        resp_json = self._decoder.loads(resp.content)
+
+        timing = getattr(resp, 'timing', None)
+        if timing is not None:
+            timing.parsed()
 
         if not resp_json['ok']:
             raise APIResponseError(resp.status_code, resp_json['error'])
 
         return resp_json
 
+    def run_async(self, func):
+        """Run `func`, a function returning a Future, to completion on the
+        purse's private IOLoop and return the result. Coroutines passed in
+        can use self._async_session."""
+        if self._io_loop is None:
+            self._io_loop = IOLoop()
+
+        def run():
+            if self._async_session is None:
+                # AsyncHTTPClient binds to the current IOLoop
+                self._async_session = AsyncAPISession(
+                    pipelining=self._pipelining, url_base=self._url_base,
+                    latency=self.latency, throttle=self.throttle)
+            return func()
+
+        return self._io_loop.run_sync(run)
+
+    def clock_skew(self):
+        """Rolling estimate of seconds the venue's clock is ahead of ours,
+        from the timestamps on our orders. None until an order is sent."""
+        return self._clock.clock_skew()
+
+    def one_way_latency(self):
+        """Rolling estimate of seconds for a request to reach the venue,
+        half the round trip of orders and cancels. None until one is
+        sent."""
+        return self._clock.one_way_latency()
+
     def order(self, direction, type, qty, price=None):
+        sent_time = time.time()
         resp = self._session.order(
             self._venue, self._stock, self._account, type, qty, direction, price)
-        
-        resp_json = self._check_resp_ok_and_jsonify(resp)
-        
-        # None should be time request was sent
+        sent_time, received_time = wall_times(resp, sent_time, time.time())
+
+        return self._record_order(direction, type, qty, price,
+                                  self._check_resp_ok_and_jsonify(resp),
+                                  sent_time, received_time)
+
+    @gen.coroutine
+    def order_async(self, direction, type, qty, price=None):
+        """Like order(), but must be run on the purse's IOLoop, see
+        run_async(). Several can be in flight at once, e.g.
+
+            purse.run_async(lambda: [
+                purse.order_async('buy', 'limit', 100, price)
+                for price in (5000, 4990, 4980)])
+        """
+        sent_time = time.time()
+        resp = yield self._async_session.order(
+            self._venue, self._stock, self._account, type, qty, direction, price)
+        sent_time, received_time = wall_times(resp, sent_time, time.time())
+
+        raise gen.Return(self._record_order(
+            direction, type, qty, price, self._check_resp_ok_and_jsonify(resp),
+            sent_time, received_time))
+
+    def _record_order(self, direction, type, qty, price, resp_json, sent_time,
+                      received_time):
         order = Order(
             self._venue, self._stock, self._account, direction, type, qty,
-            price, None, resp_json)
+            price, sent_time, resp_json, self._validator, received_time)
+        self._clock.add(sent_time, received_time, order.server_order_time)
+
+        with self._lock:
+            # Update internal values
+            self._position -= order.qty_sent()
+            self._basis -= order.cost()
+
+            last_fill_price = order.last_fill_price()
+            if last_fill_price is not None:
+                self._last_fill_price = last_fill_price
+
+            self._orders[order.id] = order
+            self._track_resting(order, 1)
+
+            if order.is_open():
+                if order.is_ask():
+                    self._open_asks.add(order.id)
+                else:
+                    self._open_bids.add(order.id)
+            else:
+                self._record_closed(order)
+
+            # Executions for this order may have beaten the response here
+            if self._execution_source is not None:
+                early_update = self._execution_source.claim(order.id)
+                if early_update is not None:
+                    self._apply_update(order, early_update)
+
+        return order
+
+    def set_execution_source(self, execution_source):
+        """See executions.ExecutionsConsumer.add_purse()."""
+        self._execution_source = execution_source
+
+    def owns(self, id):
+        return id in self._orders or (
+            self._archive is not None and id in self._archive)
+
+    def apply_order_update(self, resp_json):
+        """Bring one of our orders up to date with `resp_json`, its state as
+        sent by the venue. Returns False if the order isn't one of ours."""
+        with self._lock:
+            order = self._orders.get(resp_json['id'])
+            if order is None:
+                # Archived orders are closed, there's nothing to update
+                return self.owns(resp_json['id'])
+            self._apply_update(order, resp_json)
+            return True
+
+    def refresh(self, id):
+        """Fetch the latest state of order `id` from the venue."""
+        resp = self._session.order_status(self._venue, self._stock, id)
+        self.apply_order_update(self._check_resp_ok_and_jsonify(resp))
+        return self.get_order(id)
+
+    def refresh_open_orders(self):
+        for id in list(self._open_bids) + list(self._open_asks):
+            try:
+                self.refresh(id)
+            except APIResponseError as e:
+                logging.warning('could not refresh order %s, status code: %s',
+                                id, e.status_code)
+
+    def _apply_update(self, order, resp_json):
+        was_open = order.is_open()
+        self._track_resting(order, -1)
+        cost_diff, qty_sent_diff = order.update(resp_json)
+        self._track_resting(order, 1)
 
         # Update internal values
-        self._position -= order.qty_sent()
-        self._basis -= order.cost()
+        self._basis -= cost_diff
+        self._position -= qty_sent_diff
 
         last_fill_price = order.last_fill_price()
         if last_fill_price is not None:
             self._last_fill_price = last_fill_price
 
-        self._orders[order.id] = order
+        if was_open and not order.is_open():
+            if order.is_ask():
+                self._open_asks.discard(order.id)
+            else:
+                self._open_bids.discard(order.id)
+            self._record_closed(order)
 
+    def _record_closed(self, order):
         if order.is_ask():
-            if order.is_open():
-                self._open_asks.add(order.id)
-            else:
-                self._closed_asks.add(order.id)
+            self._closed_asks.add(order.id)
         else:
-            if order.is_open():
-                self._open_bids.add(order.id)
+            self._closed_bids.add(order.id)
+        if self._execution_source is not None:
+            self._execution_source.forget(order.id)
+
+        if self._max_closed_orders is None:
+            return
+        self._closed_ids.append(order.id)
+        while len(self._closed_ids) > self._max_closed_orders:
+            id = self._closed_ids.popleft()
+            oldest = self._orders.pop(id)
+            self._archive.append(oldest.to_record())
+            if oldest.is_ask():
+                self._closed_asks.discard(id)
             else:
-                self._closed_bids.add(order.id)
-
-        return order
+                self._closed_bids.discard(id)
 
 
     def buy(self, type, qty, price=None):
@@ -175,7 +624,61 @@ class StockPurse:
         return self.order('sell', type, qty, price)
 
 
-    def cancel_all(self):
+    def submit_ladder(self, direction, legs, type='limit'):
+        """Send an order for every (price, qty) in `legs` at once and wait
+        for all the responses before updating the purse.
+
+        Returns one entry per leg, in ascending price order: the Order, or the
+        APIResponseError if that leg failed. Transport errors are reported
+        with status code 599, like tornado does."""
+        legs = sorted(legs)
+
+        @gen.coroutine
+        def send(price, qty):
+            sent_time = time.time()
+            try:
+                resp = yield self._async_session.order(
+                    self._venue, self._stock, self._account, type, qty,
+                    direction, price)
+            except (HTTPError, IOError, OSError) as e:
+                raise gen.Return((APIResponseError(599, str(e)), sent_time,
+                                  time.time()))
+            sent_time, received_time = wall_times(resp, sent_time,
+                                                  time.time())
+            # Decoded as each leg's response arrives, so its parse isn't
+            # timed as waiting for the slowest leg
+            try:
+                resp_json = self._check_resp_ok_and_jsonify(resp)
+            except APIResponseError as e:
+                resp_json = e
+            raise gen.Return((resp_json, sent_time, received_time))
+
+        resps = self.run_async(
+            lambda: [send(price, qty) for price, qty in legs])
+
+        ret = []
+        for (price, qty), (resp_json, sent_time, received_time) in zip(
+                legs, resps):
+            if isinstance(resp_json, APIResponseError):
+                ret.append(resp_json)
+                continue
+            ret.append(self._record_order(direction, type, qty, price,
+                                          resp_json, sent_time, received_time))
+
+        return ret
+
+
+    def cancel_all(self, concurrent=False):
+        """Cancel every open order, returns dict of ID to Order.
+
+        With `concurrent`, every DELETE is sent at once and each response is
+        applied as it arrives. A cancel that fails maps to its
+        APIResponseError instead of raising, and the time from sending the
+        first DELETE to receiving the last response is kept, see
+        last_cancel_all_secs()."""
+        if concurrent:
+            return self._cancel_all_concurrently()
+
         ret = {}
         open_orders = list(self._open_bids) + list(self._open_asks)
         for id in open_orders:
@@ -184,40 +687,95 @@ class StockPurse:
         return ret
 
 
+    def _cancel_all_concurrently(self):
+        ret = {}
+        open_orders = list(self._open_bids) + list(self._open_asks)
+        if len(open_orders) == 0:
+            return ret
+
+        @gen.coroutine
+        def cancel_each():
+            start = monotonic()
+            sent_times = []
+            futures = []
+            for id in open_orders:
+                sent_times.append(time.time())
+                futures.append(self._async_session.cancel_order(
+                    self._venue, self._stock, id))
+
+            responses = gen.WaitIterator(*futures)
+            while not responses.done():
+                try:
+                    resp = yield responses.next()
+                except (HTTPError, IOError, OSError) as e:
+                    resp = APIResponseError(599, str(e))
+                id = open_orders[responses.current_index]
+                if isinstance(resp, APIResponseError):
+                    ret[id] = resp
+                    continue
+                with self._lock:
+                    order = self._orders.get(id)
+                if order is None:
+                    # Closed by an execution and archived while the DELETE
+                    # was in flight, there's nothing left to cancel
+                    ret[id] = self.get_order(id)
+                    continue
+                sent_time, received_time = wall_times(
+                    resp, sent_times[responses.current_index], time.time())
+                try:
+                    ret[id] = self._record_cancel(
+                        order, resp, sent_time, received_time)
+                except APIResponseError as e:
+                    ret[id] = e
+
+            raise gen.Return(monotonic() - start)
+
+        self._last_cancel_all_secs = self.run_async(cancel_each)
+        logging.info('cancelled %d orders in %.3f secs',
+                     len(open_orders), self._last_cancel_all_secs)
+
+        return ret
+
+
+    def last_cancel_all_secs(self):
+        """Seconds from the first DELETE sent to the last response received
+        on the last concurrent cancel_all(), or None if there hasn't been one."""
+        return self._last_cancel_all_secs
+
+
     def cancel(self, id):
         # Will throw KeyError if id new
-        order_to_cancel = self._orders[id]
+        order_to_cancel = self.get_order(id)
 
         if not order_to_cancel.is_open():
             return order_to_cancel
 
         # Send the cancel message
+        sent_time = time.time()
         resp = self._session.cancel_order(
             self._venue, self._stock, order_to_cancel.id)
+        sent_time, received_time = wall_times(resp, sent_time, time.time())
 
-        resp_json = self._check_resp_ok_and_jsonify(resp)
+        return self._record_cancel(order_to_cancel, resp, sent_time,
+                                   received_time)
 
-        cost_diff, qty_sent_diff = order_to_cancel.update(resp_json)
 
-        # Update internal values
-        self._basis -= cost_diff
-        self._position -= qty_sent_diff
-        
-        last_fill_price = order_to_cancel.last_fill_price()
-        if last_fill_price is not None:
-            self._last_fill_price = last_fill_price
+    def _record_cancel(self, order_to_cancel, resp, sent_time,
+                       received_time):
+        resp_json = self._check_resp_ok_and_jsonify(resp)
+
+        # The response's ts is when the order was placed, so there's no
+        # venue time for the cancel itself
+        self._clock.add(sent_time, received_time)
+        with self._lock:
+            order_to_cancel.cancel_sent_time = sent_time
+            order_to_cancel.cancel_received_time = received_time
+            self._apply_update(order_to_cancel, resp_json)
 
         if order_to_cancel.is_open():
             # Throw error?
             pass
 
-        if order_to_cancel.is_ask():
-            self._open_asks.remove(id)
-            self._closed_asks.add(id)
-        else:
-            self._open_bids.remove(id)
-            self._closed_bids.add(id)
-            
         return order_to_cancel
 
 
@@ -242,7 +800,148 @@ class StockPurse:
         return resp_json
 
 
-class Order:
+def check_order_response(req_venue, req_stock, req_account, req_direction,
+                         req_type, req_qty, req_price, resp_json):
+    """Print and log anything in an order response that doesn't match the
+    request or doesn't add up."""
+    # Validate response against request
+    log_req_and_resp = False
+    if req_account != resp_json['account']:
+        print('Request account "{}" does not match response account "{}". See WARNING in logs.'.
+              format(req_account, resp_json['account']))
+        log_req_and_resp = True
+    if req_direction != resp_json['direction']:
+        print('Request direction "{}" does not match response direction "{}". See WARNING in logs.'.
+              format(req_direction, resp_json['direction']))
+        log_req_and_resp = True
+    if req_qty != resp_json['originalQty']:
+        print('Request qty "{}" does not match response originalQty "{}". See WARNING in logs.'.
+              format(req_qty, resp_json['originalQty']))
+        log_req_and_resp = True
+    if req_price != resp_json['price']:
+        print('Request price "{}" does not match response price "{}". See WARNING in logs.'.
+              format(req_price, resp_json['price']))
+        log_req_and_resp = True
+    if req_type != resp_json['orderType']:
+        print('Request type "{}" does not match response type "{}". See WARNING in logs.'.
+              format(req_type, resp_json['orderType']))
+        log_req_and_resp = True
+    #resp_json['ts']
+
+    # Check internal consistency of response
+    log_resp = False
+    sum_fill_qtys = sum(f['qty'] for f in resp_json['fills'])
+    if resp_json['totalFilled'] != sum_fill_qtys:
+        print('Response totalFilled {} does not match sum of fill qtys {}. See WARNING in logs.'
+              .format(resp_json['totalFilled'], sum_fill_qtys))
+        log_resp = True
+    if (req_type == 'limit' and
+        resp_json['qty'] != resp_json['originalQty'] - sum_fill_qtys):
+        print('Response qty {} is not equal to originalQty - sum of fill qtys {}. See WARNING in logs.'
+              .format(resp_json['qty'], resp_json['originalQty'] - sum_fill_qtys))
+        log_resp = True
+
+    # Check response doesn't contain extra data, for now only check top
+    # level keys.
+    unexpected_keys = [key for key in resp_json
+                       if key not in Order.expected_top_keys]
+    if len(unexpected_keys) > 0:
+        print('Response has unexpected_keys {}. See WARNING in logs.'
+              .format(', '.join(unexpected_keys)))
+        log_resp = True
+
+    if log_req_and_resp:
+        logging.warning(
+            ('request and response mismatch.\n'
+             'Request params:\n  venue: %s\n  stock: %s\n  account: %s\n'
+             '  direction: %s\n  type: %s\n  quantity: %s\n  price:  %s\n\n'
+             'Response JSON:\n%s'),
+            req_venue, req_stock, req_account, req_direction, req_type,
+            req_qty, req_price,
+            json.dumps(resp_json, indent=4, separators=(',', ': ')))
+    elif log_resp:
+        logging.warning(
+            'response inconsistent.\nResponse JSON:\n%s',
+            json.dumps(resp_json, indent=4, separators=(',', ': ')))
+
+
+class ResponseValidator:
+    """How thoroughly Orders check their responses, see
+    check_order_response().
+
+    'full' checks every response as it arrives. 'sampled' checks one in
+    every `sample_every`. 'deferred' checks every response, but on a
+    background thread so the order path only pulls out the fields it needs;
+    if that thread falls more than `max_pending` responses behind, the rest
+    are counted in `num_dropped` and not checked."""
+
+    MODES = ('full', 'sampled', 'deferred')
+
+    def __init__(self, mode='full', sample_every=100, max_pending=10000):
+        if mode not in self.MODES:
+            raise ValueError('validation mode must be one of {}, not {!r}'
+                             .format(', '.join(self.MODES), mode))
+        self.mode = mode
+        self._sample_every = sample_every
+        self._num_seen = 0
+        self.num_dropped = 0
+        self._pending = None
+        if mode == 'deferred':
+            self._pending = queue.Queue(max_pending)
+            thread = threading.Thread(target=self._check_pending,
+                                      name='ResponseValidator')
+            thread.daemon = True
+            thread.start()
+
+    def check(self, *args):
+        """Takes the same arguments as check_order_response()."""
+        if self.mode == 'full':
+            check_order_response(*args)
+        elif self.mode == 'sampled':
+            self._num_seen += 1
+            if self._num_seen % self._sample_every == 0:
+                check_order_response(*args)
+        else:
+            try:
+                self._pending.put_nowait(args)
+            except queue.Full:
+                self.num_dropped += 1
+
+    def _check_pending(self):
+        while True:
+            args = self._pending.get()
+            try:
+                check_order_response(*args)
+            except Exception:
+                logging.exception('could not check order response')
+            finally:
+                self._pending.task_done()
+
+    def join(self):
+        """Wait for the deferred checks queued so far."""
+        if self._pending is not None:
+            self._pending.join()
+
+
+# Every order repeats the same few venue, symbol and account strings, share
+# one copy of each
+_shared_strings = {}
+
+def _shared(string):
+    return _shared_strings.setdefault(string, string)
+
+
+class Order(object):
+    """One of our orders. Kept compact since StockPurse holds on to every
+    order it sends: no per-instance __dict__, and fills are stored as
+    parallel arrays of price, qty and time since the order was placed rather
+    than as the response's list of dicts."""
+
+    __slots__ = ('id', 'server_order_time', 'symbol', 'venue', 'direction',
+                 'type', 'qty', 'price', 'account', 'total_filled',
+                 'filled_notional', 'open', 'sent_time', 'received_time',
+                 'cancel_sent_time', 'cancel_received_time', '_fill_prices',
+                 '_fill_qtys', '_fill_offsets')
 
     expected_top_keys = set(
             ['ok', 'id', 'ts', 'account', 'venue', 'symbol', 'direction',
@@ -251,82 +950,103 @@ class Order:
     expected_fill_keys = set(['price', 'qty', 'ts'])
 
     def __init__(self, req_venue, req_stock, req_account, req_direction,
-                 req_type, req_qty, req_price, request_time, resp_json):
-        # Validate response against request
-        log_req_and_resp = False
-        if req_account != resp_json['account']:
-            print('Request account "{}" does not match response account "{}". See WARNING in logs.'.
-                  format(req_account, resp_json['account']))
-            log_req_and_resp = True
-        if req_direction != resp_json['direction']:
-            print('Request direction "{}" does not match response direction "{}". See WARNING in logs.'.
-                  format(req_direction, resp_json['direction']))
-            log_req_and_resp = True
-        if req_qty != resp_json['originalQty']:
-            print('Request qty "{}" does not match response originalQty "{}". See WARNING in logs.'.
-                  format(req_qty, resp_json['originalQty']))
-            log_req_and_resp = True
-        if req_price != resp_json['price']:
-            print('Request price "{}" does not match response price "{}". See WARNING in logs.'.
-                  format(req_price, resp_json['price']))
-            log_req_and_resp = True
-        if req_type != resp_json['orderType']:
-            print('Request type "{}" does not match response type "{}". See WARNING in logs.'.
-                  format(req_type, resp_json['type']))
-            log_req_and_resp = True
-        #resp_json['ts']
-
-        # Check internal consistency of response
-        log_resp = False
-        sum_fill_qtys = sum(f['qty'] for f in resp_json['fills'])
-        if resp_json['totalFilled'] != sum_fill_qtys:
-            print('Response totalFilled {} does not match sum of fill qtys {}. See WARNING in logs.'
-                  .format(resp_json['totalFilled'], sum_fill_qtys))
-            log_resp = True
-        if (req_type == 'limit' and
-            resp_json['qty'] != resp_json['originalQty'] - sum_fill_qtys):
-            print('Response qty {} is not equal to originalQty - sum of fill qtys {}. See WARNING in logs.'
-                  .format(resp_json['qty'], resp_json['originalQty'] - sum_fill_qtys))
-            log_resp = True
-
-        # Check response doesn't contain extra data, for now only check top
-        # level keys.
-        unexpected_keys = [key for key in resp_json
-                           if key not in self.expected_top_keys]
-        if len(unexpected_keys) > 0:
-            print('Response has unexpected_keys {}. See WARNING in logs.'
-                  .format(', '.join(unexpected_keys)))
-            log_resp = True
-
-        if log_req_and_resp:
-            logging.warning(
-                ('request and response mismatch.\n'
-                 'Request params:\n  venue: %s\n  stock: %s\n  account: %s\n',
-                 '  direction: %s\n  type: %s\n  quantity: %s\n  price:  %s\n\n',
-                 'Response JSON:\n%s'),
-                req_venue, req_stock, req_account, req_direction, req_type,
-                req_qty, req_price,
-                json.dumps(resp_json, indent=4, separators=(',', ': ')))
-        elif log_resp:
-            logging.warning(
-                'response inconsistent.\nResponse JSON:\n%s',
-                json.dumps(resp_json, indent=4, separators=(',', ': ')))
+                 req_type, req_qty, req_price, request_time, resp_json,
+                 validator=None, received_time=None):
+        """Checks `resp_json` against the request with `validator`, a
+        ResponseValidator, or in full straight away if None.
+
+        `request_time` and `received_time` are the wall clock times the
+        request was sent and the response received, if known. The same for
+        the order's cancel are set by StockPurse."""
+        if validator is None:
+            check_order_response(req_venue, req_stock, req_account,
+                                 req_direction, req_type, req_qty, req_price,
+                                 resp_json)
+        else:
+            validator.check(req_venue, req_stock, req_account, req_direction,
+                            req_type, req_qty, req_price, resp_json)
 
         self.id = resp_json['id']
-        #self.req_time = req_time
-        self.server_order_time = resp_json['ts']
-
-        self.symbol = resp_json['symbol']
-        self.venue = resp_json['venue']
-        self.direction = resp_json['direction']
-        self.type = resp_json['orderType']
+        # All seconds since the epoch
+        self.sent_time = request_time
+        self.received_time = received_time
+        self.server_order_time = parse_ts(resp_json['ts'])
+        self.cancel_sent_time = None
+        self.cancel_received_time = None
+
+        self.symbol = _shared(resp_json['symbol'])
+        self.venue = _shared(resp_json['venue'])
+        self.direction = _shared(resp_json['direction'])
+        self.type = _shared(resp_json['orderType'])
         self.qty = resp_json['originalQty']
         self.price = resp_json['price']
-        self.account = resp_json['account']
-        self.fills = resp_json['fills']
-        self.total_filled = sum_fill_qtys
+        self.account = _shared(resp_json['account'])
+        self.total_filled = 0
+        # Unsigned, see cost()
+        self.filled_notional = 0
         self.open = resp_json['open']
-
+        # Created on the first fill, many orders never get one
+        self._fill_prices = None
+        self._fill_qtys = None
+        self._fill_offsets = None
+        self._add_fills(resp_json['fills'])
+
+    def _add_fills(self, fills):
+        """Append `fills` from a response, returns (qty, notional) added."""
+        if len(fills) == 0:
+            return (0, 0)
+        if self._fill_prices is None:
+            self._fill_prices = array('l')
+            self._fill_qtys = array('l')
+            self._fill_offsets = array('d')
+
+        qty_added = 0
+        notional_added = 0
+        for fill in fills:
+            self._fill_prices.append(fill['price'])
+            self._fill_qtys.append(fill['qty'])
+            self._fill_offsets.append(
+                parse_ts(fill['ts']) - self.server_order_time)
+            qty_added += fill['qty']
+            notional_added += fill['price'] * fill['qty']
+
+        self.total_filled += qty_added
+        self.filled_notional += notional_added
+        return (qty_added, notional_added)
+
+    def num_fills(self):
+        return 0 if self._fill_prices is None else len(self._fill_prices)
+
+    def fills(self):
+        """List of (price, qty, ts) for each fill, ts in seconds since the
+        epoch."""
+        if self._fill_prices is None:
+            return []
+        return [(price, qty, self.server_order_time + offset)
+                for price, qty, offset in zip(
+                    self._fill_prices, self._fill_qtys, self._fill_offsets)]
+
+    def to_record(self):
+        """The order as a JSON-able dict, see from_record()."""
+        record = dict((name, getattr(self, name)) for name in self.__slots__)
+        for name in ('_fill_prices', '_fill_qtys', '_fill_offsets'):
+            if record[name] is not None:
+                record[name] = record[name].tolist()
+        return record
+
+    @classmethod
+    def from_record(cls, record):
+        """Rebuild an order from to_record(), without checking it again."""
+        order = cls.__new__(cls)
+        for name in cls.__slots__:
+            setattr(order, name, record[name])
+        for name in ('symbol', 'venue', 'direction', 'type', 'account'):
+            setattr(order, name, _shared(record[name]))
+        if record['_fill_prices'] is not None:
+            order._fill_prices = array('l', record['_fill_prices'])
+            order._fill_qtys = array('l', record['_fill_qtys'])
+            order._fill_offsets = array('d', record['_fill_offsets'])
+        return order
 
     def is_open(self):
         return self.open
@@ -336,8 +1056,7 @@ class Order:
 
     def cost(self):
         """Negative if ask, positive if bid"""
-        abs_cost = sum(f['price'] * f['qty'] for f in self.fills)
-        return -abs_cost if self.is_ask() else abs_cost
+        return -self.filled_notional if self.is_ask() else self.filled_notional
 
     def qty_sent(self):
         return self.total_filled if self.is_ask() else -self.total_filled
@@ -349,11 +1068,19 @@ class Order:
         return self.qty - self.total_filled
 
     def last_fill_price(self):
-        return self.fills[-1]['price'] if len(self.fills) > 0 else None
+        return self._fill_prices[-1] if self.num_fills() > 0 else None
 
     def update(self, resp_json):
         """Returns 2-tuple: (cost_diff, qty_sent_diff)"""
 
+        # Updates come from both REST responses and the executions
+        # websocket, so an older state can arrive after a newer one
+        num_old_fills = self.num_fills()
+        num_fills = len(resp_json['fills'])
+        if (num_fills < num_old_fills or
+                (num_fills == num_old_fills and not self.open)):
+            return (0, 0)
+
         if not self.open:
             # Hmm I can get updates to closed orders by hitting either of the
             # 'status for all orders' endpoints
@@ -372,32 +1099,32 @@ class Order:
             pass
         if self.price != resp_json['price']:
             pass
-        if any(old != new for old, new in zip(self.fills, resp_json['fills'])):
+        if (num_old_fills > 0 and
+                self._fill_qtys[-1] !=
+                resp_json['fills'][num_old_fills - 1]['qty']):
             pass
 
-        new_cost_abs = sum(f['price'] * f['qty'] for f in resp_json['fills'])
-        new_cost = -new_cost_abs if self.is_ask() else new_cost_abs
-        cost_diff = new_cost - self.cost()
+        # Fills only ever get appended, so only look at the ones we haven't
+        # seen
+        qty_diff, notional_diff = self._add_fills(
+            resp_json['fills'][num_old_fills:])
 
-        sum_new_fill_qtys = sum(f['qty'] for f in resp_json['fills'])
-        qty_diff = sum_new_fill_qtys - self.total_filled
+        cost_diff = -notional_diff if self.is_ask() else notional_diff
         qty_sent_diff = qty_diff if self.is_ask() else -qty_diff
 
-        self.fills = resp_json['fills']
-        self.total_filled = sum_new_fill_qtys
         self.open = resp_json['open']
 
         return (cost_diff, qty_sent_diff)
 
 
-def quote(venue, stock):
-    url = ('https://api.stockfighter.io/ob/api/venues/{}/stocks/{}/quote'
-        .format(venue, stock))
+def quote(venue, stock, url_base=API_URL_BASE):
+    url = ('{}/venues/{}/stocks/{}/quote'
+        .format(url_base, venue, stock))
     return(requests.get(url))
 
-def orderbook(venue, stock):
-    url = ('https://api.stockfighter.io/ob/api/venues/{}/stocks/{}'
-        .format(venue, stock))
+def orderbook(venue, stock, url_base=API_URL_BASE):
+    url = ('{}/venues/{}/stocks/{}'
+        .format(url_base, venue, stock))
     return(requests.get(url))
 
 
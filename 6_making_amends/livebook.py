@@ -0,0 +1,290 @@
+from __future__ import print_function
+
+import json
+import logging
+import threading
+
+from ws4py.client.threadedclient import WebSocketClient
+
+from lib import APIResponseError, monotonic, parse_ts
+
+
+class FeedClient(WebSocketClient):
+    """Passes every JSON message from a venue websocket to `on_message`, and
+    calls `on_closed` when the socket goes away. Runs on ws4py's thread."""
+
+    def __init__(self, url, on_message, on_closed=None):
+        WebSocketClient.__init__(self, url)
+        self._on_message = on_message
+        self._on_closed = on_closed
+
+    def received_message(self, m):
+        if not m.is_text:
+            return
+        try:
+            message = json.loads(m.data.decode('utf-8'))
+        except ValueError:
+            logging.warning('bad JSON from %s: %r', self.url, m.data)
+            return
+        self._on_message(message)
+
+    def closed(self, code, reason=None):
+        logging.info('websocket %s closed, code: %s, reason: %s',
+                     self.url, code, reason)
+        if self._on_closed is not None:
+            self._on_closed(self)
+
+
+class LiveOrderBook:
+    """The order book for a StockPurse's stock, kept up to date from the
+    venue's tickertape and our executions instead of by polling.
+
+    The tickertape gives the best price and size on each side plus the
+    total depth, and our executions say which resting orders we traded
+    with. That keeps the top of the book exact. Deeper levels come from a
+    REST snapshot. When the depth in the latest quote no longer matches the
+    levels we hold, as it won't whenever anyone rests an order below the
+    top, the book is marked stale and a read fetches a fresh snapshot, but
+    at most once every `min_resync_secs`. In between, reads make no network
+    calls, and the levels below the top may be that far behind.
+
+    The two feeds arrive on different threads, so every quote, execution
+    and snapshot is applied only if it is newer than what the book already
+    reflects. A snapshot older than that is dropped and the book stays
+    stale. A dropped feed is reconnected with exponential backoff, and
+    until it is back reads fetch a snapshot every `min_resync_secs`, stale
+    or not.
+
+        live_book = LiveOrderBook(purse)
+        live_book.start()
+        live_book.best_bid()
+
+    `updated` is a threading.Event set only when the book changes, for
+    waiting on it to fill in, see retry.RetryPolicy.
+    """
+
+    def __init__(self, stock_purse, min_resync_secs=1.0, reconnect_delay=0.5,
+                 max_reconnect_delay=30):
+        self._stock_purse = stock_purse
+        self._min_resync_secs = min_resync_secs
+        self._reconnect_delay = reconnect_delay
+        self._max_reconnect_delay = max_reconnect_delay
+        self._lock = threading.Lock()
+        self._bids = {}
+        self._asks = {}
+        # Venue time of the newest quote, execution or snapshot applied
+        self._applied_secs = None
+        self._ts = None
+        self._stale = True
+        self._last_resync = None
+        self._running = False
+        # (url, on_message) for each feed, and the feeds themselves
+        self._feed_args = []
+        self._feeds = []
+        self._next_delays = []
+        # Indexes of the feeds that are down
+        self._down = set()
+        self.num_resyncs = 0
+        self.num_reconnects = 0
+        self.updated = threading.Event()
+
+    def start(self):
+        ws_base = self._stock_purse.ws_url_base()
+        account = self._stock_purse.account()
+        venue = self._stock_purse.venue()
+        stock = self._stock_purse.stock()
+        self._feed_args = [
+            ('{}/{}/venues/{}/tickertape/stocks/{}'
+             .format(ws_base, account, venue, stock), self.on_tickertape),
+            ('{}/{}/venues/{}/executions/stocks/{}'
+             .format(ws_base, account, venue, stock), self.on_execution),
+        ]
+        self._feeds = [None] * len(self._feed_args)
+        self._next_delays = [self._reconnect_delay] * len(self._feed_args)
+        self._down = set(range(len(self._feed_args)))
+        self._running = True
+        for idx in range(len(self._feed_args)):
+            self._connect(idx)
+        self.resync()
+
+    def stop(self):
+        self._running = False
+        feeds, self._feeds = self._feeds, []
+        for feed in feeds:
+            if feed is not None:
+                feed.close()
+
+    def _connect(self, idx):
+        if not self._running:
+            return
+        url, on_message = self._feed_args[idx]
+        feed = FeedClient(url, on_message, self._on_feed_closed)
+        try:
+            feed.connect()
+        except Exception as e:
+            logging.warning('live book connect to %s failed: %s', url, e)
+            self._schedule_reconnect(idx)
+            return
+        with self._lock:
+            if not self._running:
+                feed.close()
+                return
+            self._feeds[idx] = feed
+            self._next_delays[idx] = self._reconnect_delay
+            self._down.discard(idx)
+            # Anything could have happened while it was down
+            self._stale = True
+            self._last_resync = None
+
+    def _on_feed_closed(self, feed):
+        with self._lock:
+            if feed not in self._feeds:
+                return
+            idx = self._feeds.index(feed)
+            self._feeds[idx] = None
+            self._down.add(idx)
+            # Updates may have been missed, don't trust the book until a
+            # resync
+            self._stale = True
+        self._schedule_reconnect(idx)
+
+    def _schedule_reconnect(self, idx):
+        if not self._running:
+            return
+        self.num_reconnects += 1
+        delay = self._next_delays[idx]
+        self._next_delays[idx] = min(delay * 2, self._max_reconnect_delay)
+        logging.info('reconnecting to %s in %.1f secs',
+                     self._feed_args[idx][0], delay)
+        timer = threading.Timer(delay, self._connect, (idx,))
+        timer.daemon = True
+        timer.start()
+
+    def resync(self):
+        """Replace the book with a REST snapshot."""
+        with self._lock:
+            self._last_resync = monotonic()
+        try:
+            orderbook = self._stock_purse.orderbook()
+        except APIResponseError as e:
+            logging.warning('orderbook resync failed, status code: %s',
+                            e.status_code)
+            return
+        snapshot_secs = parse_ts(orderbook['ts'])
+        bids = dict((level['price'], level['qty'])
+                    for level in orderbook['bids'] or [])
+        asks = dict((level['price'], level['qty'])
+                    for level in orderbook['asks'] or [])
+        with self._lock:
+            # Quotes or executions newer than the snapshot have been applied
+            # while it was in flight, keep them and stay stale
+            if (self._applied_secs is not None and
+                    snapshot_secs < self._applied_secs):
+                return
+            changed = bids != self._bids or asks != self._asks
+            self._bids = bids
+            self._asks = asks
+            self._ts = orderbook['ts']
+            self._applied_secs = snapshot_secs
+            self._stale = False
+            self.num_resyncs += 1
+        if changed:
+            self.updated.set()
+
+    def on_tickertape(self, message):
+        if not message.get('ok'):
+            return
+        quote = message['quote']
+        quote_secs = parse_ts(quote['quoteTime'])
+        with self._lock:
+            # Messages can arrive out of order, and an execution may have
+            # got here first, keep the newest. A quote stamped the same as
+            # an execution already has it in its sizes.
+            if (self._applied_secs is not None and
+                    quote_secs < self._applied_secs):
+                return
+            self._applied_secs = quote_secs
+            self._ts = quote['quoteTime']
+            self._apply_top(self._bids, quote.get('bid'), quote['bidSize'],
+                            quote['bidDepth'], is_bid=True)
+            self._apply_top(self._asks, quote.get('ask'), quote['askSize'],
+                            quote['askDepth'], is_bid=False)
+        self.updated.set()
+
+    def _apply_top(self, levels, price, size, depth, is_bid):
+        if price is None or size == 0:
+            levels.clear()
+        else:
+            # Anything better than the new best price has gone
+            for level_price in list(levels):
+                if (level_price > price) if is_bid else (level_price < price):
+                    del levels[level_price]
+            levels[price] = size
+
+        if sum(levels.values()) != depth:
+            self._stale = True
+
+    def on_execution(self, message):
+        if not message.get('ok'):
+            return
+        order = message['order']
+        # The standing order is the one that was on the book
+        if message['standingId'] == order['id']:
+            standing_is_bid = order['direction'] == 'buy'
+        else:
+            standing_is_bid = order['direction'] != 'buy'
+        price = message['price']
+        filled_secs = parse_ts(message['filledAt'])
+        with self._lock:
+            # A quote or snapshot from the same time or later already
+            # has this fill in it
+            if (self._applied_secs is not None and
+                    filled_secs <= self._applied_secs):
+                return
+            self._applied_secs = filled_secs
+            levels = self._bids if standing_is_bid else self._asks
+            qty = levels.get(price, 0) - message['filled']
+            if qty > 0:
+                levels[price] = qty
+            else:
+                levels.pop(price, None)
+            self._ts = message['filledAt']
+        self.updated.set()
+
+    def is_stale(self):
+        return self._stale
+
+    def _fresh(self):
+        with self._lock:
+            due = (self._stale or bool(self._down)) and (
+                self._last_resync is None or
+                monotonic() - self._last_resync >= self._min_resync_secs)
+        if due:
+            self.resync()
+
+    def best_bid(self):
+        self._fresh()
+        with self._lock:
+            return max(self._bids) if self._bids else None
+
+    def best_ask(self):
+        self._fresh()
+        with self._lock:
+            return min(self._asks) if self._asks else None
+
+    def orderbook(self):
+        """The book in the same shape as StockPurse.orderbook()."""
+        self._fresh()
+        with self._lock:
+            bids = [{'price': price, 'qty': self._bids[price], 'isBuy': True}
+                    for price in sorted(self._bids, reverse=True)]
+            asks = [{'price': price, 'qty': self._asks[price], 'isBuy': False}
+                    for price in sorted(self._asks)]
+            return {
+                'ok': True,
+                'venue': self._stock_purse.venue(),
+                'symbol': self._stock_purse.stock(),
+                'bids': bids or None,
+                'asks': asks or None,
+                'ts': self._ts,
+            }
@@ -0,0 +1,307 @@
+"""Matching engine behind venue_sim.py.
+
+Each side of a book is a dict of price to Level, where a Level is a FIFO of
+resting orders, plus a heap of the prices that have levels. Resting an order
+at a new price is a heap push, O(log n), at an existing price an append,
+O(1). The best price is the top of the heap. Cancels only mark the order
+dead and take its qty off the level, so they are O(1) too; dead orders and
+emptied prices are dropped when matching or the best price reaches them.
+"""
+
+from __future__ import print_function
+
+import collections
+import datetime
+import heapq
+
+
+ORDER_TYPES = ('limit', 'market', 'fill-or-kill', 'immediate-or-cancel')
+
+
+def timestamp():
+    return datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+class SimOrder(object):
+    __slots__ = ('id', 'account', 'venue', 'symbol', 'direction',
+                 'order_type', 'original_qty', 'qty', 'price', 'ts', 'fills',
+                 'total_filled', 'open')
+
+    def __init__(self, id, account, venue, symbol, direction, order_type,
+                 qty, price, ts):
+        self.id = id
+        self.account = account
+        self.venue = venue
+        self.symbol = symbol
+        self.direction = direction
+        self.order_type = order_type
+        self.original_qty = qty
+        self.qty = qty
+        self.price = price
+        self.ts = ts
+        self.fills = []
+        self.total_filled = 0
+        self.open = True
+
+    def is_buy(self):
+        return self.direction == 'buy'
+
+    def to_json(self, num_fills=None):
+        """The order as the API returns it. With `num_fills`, as it was
+        straight after its `num_fills`th fill."""
+        if num_fills is None:
+            fills = list(self.fills)
+            total_filled = self.total_filled
+            qty = self.qty
+            is_open = self.open
+        else:
+            fills = self.fills[:num_fills]
+            total_filled = sum(f['qty'] for f in fills)
+            qty = self.original_qty - total_filled
+            is_open = qty > 0
+
+        return {
+            'ok': True,
+            'id': self.id,
+            'ts': self.ts,
+            'account': self.account,
+            'venue': self.venue,
+            'symbol': self.symbol,
+            'direction': self.direction,
+            'orderType': self.order_type,
+            'originalQty': self.original_qty,
+            'qty': qty,
+            'price': self.price,
+            'fills': fills,
+            'totalFilled': total_filled,
+            'open': is_open,
+        }
+
+
+# One trade between a resting and an incoming order. The *_num_fills fields
+# are each order's fill count straight after this trade, see
+# SimOrder.to_json().
+Fill = collections.namedtuple(
+    'Fill', ['standing', 'incoming', 'price', 'qty', 'ts',
+             'standing_num_fills', 'incoming_num_fills'])
+
+
+class Level(object):
+    __slots__ = ('orders', 'qty')
+
+    def __init__(self):
+        self.orders = collections.deque()
+        self.qty = 0
+
+
+class BookSide(object):
+    """Levels for one side. Heap keys are prices for asks and negated prices
+    for bids, so the top of the heap is always the best price."""
+
+    __slots__ = ('is_buy', 'levels', 'depth', '_heap', '_heap_prices')
+
+    def __init__(self, is_buy):
+        self.is_buy = is_buy
+        self.levels = {}
+        self.depth = 0
+        self._heap = []
+        # Prices in _heap, including ones whose level has since emptied
+        self._heap_prices = set()
+
+    def add(self, order):
+        level = self.levels.get(order.price)
+        if level is None:
+            level = self.levels[order.price] = Level()
+            if order.price not in self._heap_prices:
+                self._heap_prices.add(order.price)
+                heapq.heappush(
+                    self._heap, -order.price if self.is_buy else order.price)
+        level.orders.append(order)
+        level.qty += order.qty
+        self.depth += order.qty
+
+    def remove(self, order):
+        """Take a resting order off the book, it's left in its level's queue
+        until it reaches the front."""
+        level = self.levels[order.price]
+        level.qty -= order.qty
+        self.depth -= order.qty
+        if level.qty == 0:
+            del self.levels[order.price]
+
+    def best_price(self):
+        heap = self._heap
+        while heap:
+            price = -heap[0] if self.is_buy else heap[0]
+            if price in self.levels:
+                return price
+            heapq.heappop(heap)
+            self._heap_prices.discard(price)
+        return None
+
+    def best_level(self):
+        price = self.best_price()
+        return None if price is None else self.levels[price]
+
+    def crosses(self, price, limit):
+        """Whether a resting `price` on this side trades against an incoming
+        order with `limit`, None for a market order."""
+        if limit is None:
+            return True
+        return price >= limit if self.is_buy else price <= limit
+
+    def qty_available(self, limit):
+        return sum(level.qty for price, level in self.levels.items()
+                   if self.crosses(price, limit))
+
+    def sorted_levels(self):
+        """[(price, qty)], best first."""
+        return sorted(((price, level.qty)
+                       for price, level in self.levels.items()),
+                      reverse=self.is_buy)
+
+
+class MatchingEngine(object):
+    """Price-time priority matching for one stock."""
+
+    def __init__(self, venue, symbol, order_ids):
+        self.venue = venue
+        self.symbol = symbol
+        self._order_ids = order_ids
+        self._bids = BookSide(is_buy=True)
+        self._asks = BookSide(is_buy=False)
+        self.last = None
+        self.last_size = None
+        self.last_trade = None
+        self.quote_time = None
+
+    def best_bid(self):
+        return self._bids.best_price()
+
+    def best_ask(self):
+        return self._asks.best_price()
+
+    def submit(self, account, direction, order_type, qty, price):
+        """Returns (order, fills), fills is a list of Fill."""
+        ts = timestamp()
+        if order_type == 'market':
+            price = 0
+        order = SimOrder(next(self._order_ids), account, self.venue,
+                         self.symbol, direction, order_type, qty, price, ts)
+
+        if order.is_buy():
+            own_side, other_side = self._bids, self._asks
+        else:
+            own_side, other_side = self._asks, self._bids
+        limit = None if order_type == 'market' else price
+
+        if (order_type == 'fill-or-kill' and
+                other_side.qty_available(limit) < qty):
+            order.qty = 0
+            order.open = False
+            return order, []
+
+        fills = self._match(order, other_side, limit, ts)
+
+        if order.qty > 0 and order_type == 'limit':
+            own_side.add(order)
+        else:
+            order.qty = 0
+            order.open = False
+
+        self.quote_time = ts
+        return order, fills
+
+    def cancel(self, order):
+        if order.open:
+            side = self._bids if order.is_buy() else self._asks
+            side.remove(order)
+            order.qty = 0
+            order.open = False
+            self.quote_time = timestamp()
+        return order
+
+    def _match(self, incoming, side, limit, ts):
+        fills = []
+        while incoming.qty > 0:
+            price = side.best_price()
+            if price is None or not side.crosses(price, limit):
+                break
+
+            level = side.levels[price]
+            queue = level.orders
+            while incoming.qty > 0 and level.qty > 0:
+                standing = queue[0]
+                if not standing.open:
+                    # Cancelled while resting
+                    queue.popleft()
+                    continue
+
+                qty = min(incoming.qty, standing.qty)
+                standing.qty -= qty
+                standing.total_filled += qty
+                standing.fills.append({'price': price, 'qty': qty, 'ts': ts})
+                incoming.qty -= qty
+                incoming.total_filled += qty
+                incoming.fills.append({'price': price, 'qty': qty, 'ts': ts})
+                level.qty -= qty
+                side.depth -= qty
+
+                if standing.qty == 0:
+                    standing.open = False
+                    queue.popleft()
+
+                fills.append(Fill(standing, incoming, price, qty, ts,
+                                  len(standing.fills), len(incoming.fills)))
+
+            if level.qty == 0:
+                del side.levels[price]
+
+            self.last = price
+            self.last_size = fills[-1].qty
+            self.last_trade = ts
+
+        return fills
+
+    def orderbook_json(self):
+        def levels(side):
+            if len(side.levels) == 0:
+                return None
+            return [{'price': price, 'qty': qty, 'isBuy': side.is_buy}
+                    for price, qty in side.sorted_levels()]
+
+        return {
+            'ok': True,
+            'venue': self.venue,
+            'symbol': self.symbol,
+            'bids': levels(self._bids),
+            'asks': levels(self._asks),
+            'ts': timestamp(),
+        }
+
+    def quote_json(self):
+        quote = {
+            'ok': True,
+            'symbol': self.symbol,
+            'venue': self.venue,
+            'bidDepth': self._bids.depth,
+            'askDepth': self._asks.depth,
+            'quoteTime': self.quote_time or timestamp(),
+        }
+        bid = self._bids.best_price()
+        if bid is not None:
+            quote['bid'] = bid
+            quote['bidSize'] = self._bids.levels[bid].qty
+        else:
+            quote['bidSize'] = 0
+        ask = self._asks.best_price()
+        if ask is not None:
+            quote['ask'] = ask
+            quote['askSize'] = self._asks.levels[ask].qty
+        else:
+            quote['askSize'] = 0
+        if self.last is not None:
+            quote['last'] = self.last
+            quote['lastSize'] = self.last_size
+            quote['lastTrade'] = self.last_trade
+        return quote
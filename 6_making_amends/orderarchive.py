@@ -0,0 +1,66 @@
+"""Append-only on-disk log of closed orders, see StockPurse's
+`max_closed_orders`.
+
+Each order is one JSON line. An in-memory index of order id to file offset
+means a lookup is one seek and one line read, however long the log gets.
+"""
+
+from __future__ import print_function
+
+import json
+import os
+import tempfile
+
+
+class OrderArchive:
+    """Records, as dicts, of orders that have been moved out of memory.
+
+    With no `path` the log is a temporary file that is deleted on close().
+    With a `path` the log is appended to, and any orders already in it can
+    be looked up."""
+
+    def __init__(self, path=None):
+        if path is None:
+            self._fp = tempfile.TemporaryFile()
+        else:
+            self._fp = open(path, 'a+b')
+        self._index = {}
+        self._index_existing()
+
+    def _index_existing(self):
+        self._fp.seek(0)
+        offset = 0
+        for line in iter(self._fp.readline, b''):
+            if line.endswith(b'\n'):
+                record = json.loads(line.decode('utf-8'))
+                self._index[record['id']] = offset
+            offset += len(line)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, id):
+        return id in self._index
+
+    def append(self, record):
+        """Write `record`, which must have an 'id', to the end of the log."""
+        line = (json.dumps(record, separators=(',', ':')) + '\n').encode('utf-8')
+        self._fp.seek(0, os.SEEK_END)
+        offset = self._fp.tell()
+        self._fp.write(line)
+        self._index[record['id']] = offset
+
+    def get(self, id):
+        """The record for order `id`, or None if it isn't in the log."""
+        offset = self._index.get(id)
+        if offset is None:
+            return None
+        self._fp.flush()
+        self._fp.seek(offset)
+        return json.loads(self._fp.readline().decode('utf-8'))
+
+    def flush(self):
+        self._fp.flush()
+
+    def close(self):
+        self._fp.close()
@@ -0,0 +1,141 @@
+"""Retrying calls to the venue, with backoff suited to what went wrong.
+
+A RetryPolicy calls an attempt until it returns, sorting each failure into
+an error class with error_class():
+
+    not_ready    the call worked but the answer isn't usable yet, e.g. an
+                 orderbook with a side missing, raised as NotReady
+    transport    no response at all
+    throttled    a 429
+    server       a 5xx
+    rejected     any other error response
+
+Each class has its own Backoff, jittered so that several clients retrying
+together don't stay in step. All the waiting for one call together is
+bounded by the policy's deadline. Waits after not_ready can also end early
+on a `wake` event, e.g. livebook.LiveOrderBook's `updated`, set when a
+websocket message shows the book has changed.
+
+    policy = RetryPolicy(deadline=2.0)
+    book = policy.call(fetch_book, wake=live_book.updated)
+"""
+
+from __future__ import print_function
+
+import logging
+import random
+import time
+
+import requests
+
+from lib import APIResponseError
+
+
+class NotReady(Exception):
+    """Raised by an attempt whose result isn't usable yet."""
+
+
+def error_class(e):
+    """The name of the error class `e` falls in, None if it isn't one to
+    retry."""
+    if isinstance(e, NotReady):
+        return 'not_ready'
+    if isinstance(e, APIResponseError):
+        if e.status_code == 429:
+            return 'throttled'
+        if e.status_code >= 500:
+            return 'server'
+        return 'rejected'
+    if isinstance(e, requests.RequestException):
+        return 'transport'
+    return None
+
+
+class Backoff(object):
+    """Waits of `base` seconds, growing by `factor` an attempt up to `cap`,
+    each jittered to somewhere between half and all of that. With
+    `wakeable`, a wake event ends the wait."""
+
+    def __init__(self, base, cap, factor=2.0, wakeable=False):
+        self.base = base
+        self.cap = cap
+        self.factor = factor
+        self.wakeable = wakeable
+
+    def delay(self, num_failures, rand):
+        """Seconds to wait after the `num_failures`th failure in a row."""
+        ceiling = min(self.cap, self.base * self.factor ** (num_failures - 1))
+        return ceiling / 2.0 + rand.uniform(0, ceiling / 2.0)
+
+
+class RetryPolicy(object):
+    """Retries with a Backoff per error class, see BACKOFFS, in at most
+    `deadline` seconds and `max_attempts` attempts in all.
+
+    Time is read from and slept on `clock`, the `time` module by default,
+    so backtest.py's SimClock can stand in."""
+
+    BACKOFFS = {
+        'not_ready': Backoff(0.05, 0.5, wakeable=True),
+        'transport': Backoff(0.1, 1.0),
+        'throttled': Backoff(0.5, 4.0),
+        'server': Backoff(0.2, 2.0),
+        'rejected': Backoff(0.2, 1.0),
+    }
+
+    def __init__(self, backoffs=None, deadline=3.0, max_attempts=None,
+                 clock=None, seed=None):
+        self.backoffs = dict(self.BACKOFFS, **(backoffs or {}))
+        self.deadline = deadline
+        self.max_attempts = max_attempts
+        self.clock = clock
+        self._rand = random.Random(seed)
+
+    def seed(self, seed):
+        """Make the jitter repeat, e.g. for a backtest."""
+        self._rand.seed(seed)
+
+    def call(self, attempt, wake=None, deadline=None, max_attempts=None,
+             clock=None):
+        """Return what `attempt()` returns, or None if it still hasn't
+        succeeded by the deadline or the last attempt. Errors that aren't
+        in a class are raised straight away. `wake` is a threading.Event,
+        cleared before each attempt. `deadline`, `max_attempts` and `clock`
+        override the policy's for this call."""
+        clock = clock or self.clock or time
+        deadline = self.deadline if deadline is None else deadline
+        if max_attempts is None:
+            max_attempts = self.max_attempts
+        give_up_at = clock.time() + deadline
+
+        failures = {}
+        num_attempts = 0
+        while True:
+            if wake is not None:
+                wake.clear()
+            num_attempts += 1
+            try:
+                return attempt()
+            except Exception as e:
+                kind = error_class(e)
+                if kind is None:
+                    raise
+                last_error = e
+
+            if max_attempts is not None and num_attempts >= max_attempts:
+                break
+            remaining = give_up_at - clock.time()
+            if remaining <= 0:
+                break
+
+            failures[kind] = failures.get(kind, 0) + 1
+            backoff = self.backoffs[kind]
+            delay = min(backoff.delay(failures[kind], self._rand), remaining)
+            if wake is not None and backoff.wakeable:
+                wake.wait(delay)
+            else:
+                clock.sleep(delay)
+
+        logging.info('gave up after %d attempts, last error: %r',
+                     num_attempts, last_error)
+        return None
@@ -1,22 +1,23 @@
 from __future__ import print_function
 
 import logging
-
-import httplib
-# There are only two debuglevel values: zero and positive
-#httplib.HTTPConnection.debuglevel = 1
-
 import time
 
-from ws4py.client.threadedclient import WebSocketClient
-import json
-
+import asyncoutput
 from lib import *
+from booksnapshot import (
+    BookDeltaStream, InformedOrderDetector, LadderPricer, OrderBookSnapshot)
+from executions import ExecutionsConsumer
+from retry import NotReady, RetryPolicy
 
 logging.basicConfig(
     format='%(asctime)s,%(msecs)d %(name)s %(levelname)s:%(message)s',
     datefmt='%H:%M:%S', level=logging.INFO, filename='logs')
 
+# Shared by get_probe_orderbook() and get_probe_quote(), so a probe gives up
+# after at most two seconds of waiting
+PROBE_RETRY = RetryPolicy(deadline=2.0)
+
 
 account = 'LAS87930542'
 venue = 'OZEX'
@@ -29,7 +30,7 @@ purse = StockPurse(
 
 
 def slow_buyer(stock_purse, target_position=-3000, qty=200, price_delta=75,
-               wait_before_cancel=4, wait_after_cancel=5):
+               wait_before_cancel=4, wait_after_cancel=5, live_book=None):
     """Try to sell lots of stock before crashing the price.
 
     To not crash the stock, sell `qty` at `price_delta` below top bid
@@ -47,9 +48,10 @@ def slow_buyer(stock_purse, target_position=-3000, qty=200, price_delta=75,
         print('')
 
         probe_book = get_probe_orderbook(
-            stock_purse, max_retries=10, pause=0.6, require_asks=False)
+            stock_purse, max_retries=10, require_asks=False,
+            live_book=live_book)
 
-        ask_price = probe_book['bids'][0]['price'] - price_delta
+        ask_price = probe_book.best_bid() - price_delta
 
         print(('\nAsking price:{price:>6}, qty:{qty:>5}...'
                    .format(qty=qty, price=ask_price)), end='')
@@ -64,7 +66,7 @@ def slow_buyer(stock_purse, target_position=-3000, qty=200, price_delta=75,
 
         time.sleep(wait_before_cancel)
 
-        stock_purse.cancel_all()
+        stock_purse.cancel_all(concurrent=True)
 
         qty_sold = stock_purse.qty_filled(ask.id)
         print('\nAt round end, sold qty: {}\n              stocks held: {}, basis: {}, NAV: {}.'
@@ -76,7 +78,8 @@ def slow_buyer(stock_purse, target_position=-3000, qty=200, price_delta=75,
 
 def decrease_maker(stock_purse, target_price=2000, crash_price_delta=400,
                    crash_qty=250, resting_qty=500, min_position=-7000,
-                   crash_lag=2, max_rounds=4):
+                   crash_lag=2, max_rounds=4, live_book=None,
+                   lag_latency_multiple=20, min_crash_lag=0.5):
     """Crash the market value of a stock by steadily decreasing ask
     prices. It appears that other traders will crash the price if
     several of their consecutive trades are filled at steadily lower
@@ -97,7 +100,9 @@ def decrease_maker(stock_purse, target_price=2000, crash_price_delta=400,
      4. Ask `resting_qty`.
      5. Cancel old asks at price higher than the last ask (we want other
         traders to always fill at a price no more than their last fill).
-     6. Wait `crash_lag` seconds.
+     6. Wait `crash_lag` seconds. With `crash_lag` None, wait
+        `lag_latency_multiple` times the purse's measured one-way latency,
+        at least `min_crash_lag`, see lag_from_latency().
      7. Go to 2.
 
     If we will either ask too far below `target_price` or if we are at
@@ -107,13 +112,14 @@ def decrease_maker(stock_purse, target_price=2000, crash_price_delta=400,
 
     # Get latest bids--we'll start at the top bid
     probe_book = get_probe_orderbook(
-        stock_purse, max_retries=12, pause=0.6, require_asks=False)
+        stock_purse, max_retries=12, require_asks=False,
+        live_book=live_book)
 
     if probe_book is None:
         print('Couldn\'t get a probe orderbook!', end='')
         return
 
-    ask_price = probe_book['bids'][0]['price']
+    ask_price = probe_book.best_bid()
 
     round_num = 0
     min_pos_buffered = min_position + crash_qty + resting_qty + 1
@@ -179,7 +185,14 @@ def decrease_maker(stock_purse, target_price=2000, crash_price_delta=400,
           .format(stock_purse.position(), stock_purse.basis(),
                   stock_purse.value()))
 
-        time.sleep(crash_lag)
+        if crash_lag is None:
+            lag = lag_from_latency(stock_purse, lag_latency_multiple,
+                                   min_crash_lag)
+            print('Waiting {:.2f} secs, one-way latency {}'.format(
+                lag, stock_purse.one_way_latency()))
+        else:
+            lag = crash_lag
+        time.sleep(lag)
 
         last_ask_ids = ask_ids
 
@@ -187,8 +200,18 @@ def decrease_maker(stock_purse, target_price=2000, crash_price_delta=400,
     finish_strat(stock_purse)
 
 
+def lag_from_latency(stock_purse, latency_multiple, min_lag, fallback=2):
+    """Seconds to give other traders to react to our orders,
+    `latency_multiple` times the one-way latency to the venue but no less
+    than `min_lag`, or `fallback` before the latency has been measured."""
+    latency = stock_purse.one_way_latency()
+    if latency is None:
+        return fallback
+    return max(min_lag, latency_multiple * latency)
+
+
 def finish_strat(stock_purse):
-    stock_purse.cancel_all()
+    stock_purse.cancel_all(concurrent=True)
     print('\nAt strat end, stocks held: {}, basis: {}, NAV: {}.'
           .format(stock_purse.position(), stock_purse.basis(),
                   stock_purse.value()))    
@@ -196,7 +219,7 @@ def finish_strat(stock_purse):
 
 def crash_maker(stock_purse, target_price=2000, crash_price_delta=400,
                 crash_qty=400, crash_rest_qty=1200, min_position=-9999,
-                crash_lag=5):
+                crash_lag=5, live_book=None):
     """Crash the market value of a stock by selling.
 
     One round of crashing works as follows:
@@ -226,14 +249,15 @@ def crash_maker(stock_purse, target_price=2000, crash_price_delta=400,
 
         # Get latest bids--we'll start at the top bid
         probe_book = get_probe_orderbook(
-            stock_purse, max_retries=10, pause=0.6, require_asks=False)
+            stock_purse, max_retries=10, require_asks=False,
+            live_book=live_book)
 
         if probe_book is None:
             print('Couldn\'t get a probe orderbook!', end='')
             continue
 
         ask_ids = []
-        ask_price = probe_book['bids'][0]['price'] - crash_price_delta
+        ask_price = probe_book.best_bid() - crash_price_delta
         qty_rested = 0
         while (qty_rested < crash_rest_qty and
                min_pos_buffered < stock_purse.position_with_open_asks() and
@@ -256,7 +280,7 @@ def crash_maker(stock_purse, target_price=2000, crash_price_delta=400,
 
         time.sleep(crash_lag)
 
-        stock_purse.cancel_all()
+        stock_purse.cancel_all(concurrent=True)
 
         qty_sold = sum(stock_purse.qty_filled(id) for id in ask_ids)
         print('\nAt round end, sold qty: {}\n              stocks held: {}, basis: {}, NAV: {}.'
@@ -268,7 +292,7 @@ def crash_maker(stock_purse, target_price=2000, crash_price_delta=400,
 def shy_maker(stock_purse, num_rounds=30, wait_secs=4, qty_tolerance=2000,
               tolerance_adjust=400, qty_marks=(250, 500, 1000, 2500, 10000, 30000),
               price_delta_fallback=300, qtys=(50, 200, 200, 200, 300, 300),
-              informed_qty=10000, informed_penalty=400):
+              informed_qty=10000, informed_penalty=400, live_book=None):
     """Every round, get orderbook and make orders with prices based on quantities
     in the orderbook vs. `qty_marks` argument. For example, at qty_mark=(50,),
     one sell order will be issued that round at the price you need to buy the
@@ -282,32 +306,39 @@ def shy_maker(stock_purse, num_rounds=30, wait_secs=4, qty_tolerance=2000,
     `informed_penalty`.
     """
 
+    # Only the levels that changed since last round get looked at again
+    book_stream = BookDeltaStream()
+    informed = InformedOrderDetector(informed_qty)
+    ask_pricer = LadderPricer(qty_marks, price_delta_fallback, are_bids=False)
+    bid_pricer = LadderPricer(qty_marks, price_delta_fallback, are_bids=True)
+    for subscriber in (informed, ask_pricer, bid_pricer):
+        book_stream.subscribe(subscriber.update)
+
     last_uninformed_ask_prices = []
     last_uninformed_bid_prices = []
     for round in range(num_rounds):
         print('')
         print('######## Round {} ########'.format(round + 1))
 
-        probe_book = get_probe_orderbook(stock_purse, max_retries=10, pause=0.6)
+        probe_book = get_probe_orderbook(
+            stock_purse, max_retries=10, live_book=live_book)
         if probe_book is None:
             print('Couldn\'t get a probe orderbook!', end='')
             continue
             
         print('')
 
-        if any_informed_orders(probe_book, threshold=informed_qty):
+        book_stream.push(probe_book)
+
+        if informed.any_informed_orders():
             #informed_orders = get_informed_orders(probe_book, threshold=informed_qty)
             ask_prices = [p + informed_penalty
                           for p in last_uninformed_ask_prices]
             bid_prices = [max(p - informed_penalty, 0)
                           for p in last_uninformed_bid_prices]
         else:
-            ask_prices = price_till_qty(
-                probe_book['asks'], qty_marks, price_delta_fallback,
-                are_bids=False)
-            bid_prices = price_till_qty(
-                probe_book['bids'], qty_marks, price_delta_fallback,
-                are_bids=True)
+            ask_prices = ask_pricer.prices
+            bid_prices = bid_pricer.prices
 
             last_uninformed_ask_prices = ask_prices
             last_uninformed_bid_prices = bid_prices
@@ -325,39 +356,18 @@ def shy_maker(stock_purse, num_rounds=30, wait_secs=4, qty_tolerance=2000,
         ask_prices = ask_prices[:idx_cumsum_gt(qtys, 9999 + position)]
         bid_prices = bid_prices[:idx_cumsum_gt(qtys, 9999 - position)]
 
-        # Send bid orders, lowest first so that the printout is easier to read
-        buy_ids = []
-        for price, qty in reversed(zip(bid_prices, qtys)):
-            print(('Bidding price:{price:>6}, qty:{qty:>5}...'
-                    .format(qty=qty, price=price)), end='')
-            try:
-                bid = stock_purse.buy('limit', qty=qty, price=price)
-            except APIResponseError as e:
-                bid = None
-                print(' FAILED {}'.format(print_order_err(e)))
-            else:
-                buy_ids.append(bid.id)
-                print(' OK, filled {} stocks, ID {}'
-                      .format(bid.qty_filled(), bid.id))
+        # Send each side as one batch, printout is lowest price first
+        bid_legs = list(zip(bid_prices, qtys))
+        bids = stock_purse.submit_ladder('buy', bid_legs)
+        buy_ids = print_ladder('Bidding', sorted(bid_legs), bids)
 
-        # Send ask orders
-        sell_ids = []
-        for price, qty in zip(ask_prices, qtys):
-            print(('Asking price: {price:>6}, qty:{qty:>5}...'
-                    .format(qty=qty, price=price)), end='')
-            try:
-                ask = stock_purse.sell('limit', qty=qty, price=price)
-            except APIResponseError as e:
-                ask = None
-                print(' FAILED {}'.format(print_order_err(e)))
-            else:
-                sell_ids.append(ask.id)
-                print(' OK, filled {} stocks, ID {}'
-                      .format(ask.qty_filled(), ask.id))
+        ask_legs = list(zip(ask_prices, qtys))
+        asks = stock_purse.submit_ladder('sell', ask_legs)
+        sell_ids = print_ladder('Asking', sorted(ask_legs), asks)
 
         time.sleep(wait_secs)
 
-        cancelled_orders = stock_purse.cancel_all()
+        cancelled_orders = stock_purse.cancel_all(concurrent=True)
 
         qty_bought = sum(stock_purse.qty_filled(id) for id in buy_ids)
         qty_sold = sum(stock_purse.qty_filled(id) for id in sell_ids)
@@ -367,10 +377,21 @@ def shy_maker(stock_purse, num_rounds=30, wait_secs=4, qty_tolerance=2000,
                       stock_purse.basis(), stock_purse.value()))
 
 
-def any_informed_orders(orderbook, threshold):
-    informed_asks = (ask['qty'] > threshold for ask in orderbook['asks'])
-    informed_bids = (bid['qty'] > threshold for bid in orderbook['bids'])
-    return any(informed_asks) or any(informed_bids)
+def print_ladder(label, legs, results):
+    """Print the outcome of StockPurse.submit_ladder() and return the IDs of
+    the orders that were accepted."""
+    ids = []
+    for (price, qty), result in zip(legs, results):
+        print(('{label} price:{price:>6}, qty:{qty:>5}...'
+               .format(label=label, qty=qty, price=price)), end='')
+        if isinstance(result, APIResponseError):
+            print(' FAILED {}'.format(print_order_err(result)))
+        else:
+            ids.append(result.id)
+            print(' OK, filled {} stocks, ID {}'
+                  .format(result.qty_filled(), result.id))
+
+    return ids
 
 
 def idx_cumsum_gt(values, threshold):
@@ -383,95 +404,55 @@ def idx_cumsum_gt(values, threshold):
     return len(values)
 
 
-def price_till_qty(orders, qtys, price_delta_fallback, are_bids):
-    """Return a list of prices."""
-
-    if len(orders) == 0 or len(qtys) == 0:
-        return None
-
-    # Make sure sign of price_delta_fallback is right
-    if (are_bids and price_delta_fallback > 0) or \
-       (not are_bids and price_delta_fallback < 0):
-        price_delta_fallback *= -1
-
-    prices = []
-    qty_so_far = 0
-    last_price = None
-    qty_idx, order_idx = (0, 0)
-
-    while qty_idx < len(qtys) and order_idx < len(orders):
-        if qty_so_far >= qtys[qty_idx]:
-            prices.append(max(last_price, 0))
-            qty_idx += 1
-        else:                
-            qty_so_far += orders[order_idx]['qty']
-            last_price = orders[order_idx]['price']
-            order_idx += 1
-
-    while qty_idx < len(qtys):
-        if qty_so_far < qtys[qty_idx]:
-            last_price += price_delta_fallback
-        prices.append(max(last_price, 0))
-        qty_idx += 1
-
-    return prices
-
-
-def get_probe_quote(stock_purse, max_retries=10):
-    probe_quote = None
-    for attempt in range(max_retries):
+def get_probe_quote(stock_purse, max_retries=10, live_book=None,
+                    deadline=None):
+    """Returns a quote with both a bid and an ask, or None. Retries with
+    PROBE_RETRY, within `deadline` seconds if given. With a
+    livebook.LiveOrderBook, a one-sided quote is retried as soon as the
+    book changes."""
+    def attempt():
         print('Issue probing quote...', end='')
         try:
-            probe_quote = stock_purse.quote()
+            quote = stock_purse.quote()
         except APIResponseError as e:
             print(' {}'.format(print_order_err(e)))
-        else:
-            print(' OK, last price: {}'.format(probe_quote['last']))
-            if 'ask' not in probe_quote or 'bid' not in probe_quote:
-                probe_quote = None
-                continue
-            else:
-                break
-
-    return probe_quote
-
-
-def get_probe_orderbook(stock_purse, max_retries=10, pause=None,
-                        require_asks=True, require_bids=True):
-    probe_orderbook = None
-    for attempt in range(max_retries):
-        if attempt != 0 and pause is not None:
-            time.sleep(pause)
-
+            raise
+        print(' OK, last price: {}'.format(quote.get('last')))
+        if 'ask' not in quote or 'bid' not in quote:
+            raise NotReady()
+        return quote
+
+    return PROBE_RETRY.call(
+        attempt, wake=live_book and live_book.updated, deadline=deadline,
+        max_attempts=max_retries, clock=time)
+
+
+def get_probe_orderbook(stock_purse, max_retries=10, require_asks=True,
+                        require_bids=True, live_book=None, deadline=None):
+    """Returns a booksnapshot.OrderBookSnapshot, or None. With a
+    livebook.LiveOrderBook, read the book from it instead of polling the
+    REST API, and retry a book missing a side as soon as it changes.
+    Retries with PROBE_RETRY, within `deadline` seconds if given."""
+    def attempt():
         print('GET orderbook...', end='')
         try:
-            probe_orderbook = stock_purse.orderbook()
+            book = live_book if live_book is not None else stock_purse
+            probe_orderbook = OrderBookSnapshot.from_json(book.orderbook())
         except APIResponseError as e:
             print(' {}'.format(print_order_err(e)))
-        else:
-            asks = probe_orderbook['asks']
-            bids = probe_orderbook['bids']
-            
-            print(' OK, number bids: {}, asks: {}'
-                  .format(0 if bids is None else len(bids),
-                          0 if asks is None else len(asks)))
+            raise
+        num_asks = len(probe_orderbook.asks)
+        num_bids = len(probe_orderbook.bids)
 
-            if require_asks:
-                need_asks = asks is None or len(asks) == 0
-            else:
-                need_asks = False
-            if require_bids:
-                need_bids = bids is None or len(bids) == 0
-            else:
-                need_bids = False
+        print(' OK, number bids: {}, asks: {}'.format(num_bids, num_asks))
 
-            if need_asks or need_bids:
-                probe_orderbook = None
-                continue
-            else:
-                break
+        if (require_asks and num_asks == 0) or (require_bids and num_bids == 0):
+            raise NotReady()
+        return probe_orderbook
 
-    return probe_orderbook
+    return PROBE_RETRY.call(
+        attempt, wake=live_book and live_book.updated, deadline=deadline,
+        max_attempts=max_retries, clock=time)
 
 
 
@@ -494,11 +475,20 @@ def print_fills(fills, n=3):
                 .format(price=fill['price'], qty=fill['qty']))
 
 
-def rolling_orderbook(secs_between_updates, num_orders_visible):
+def rolling_orderbook(secs_between_updates, num_orders_visible,
+                      capture=None):
+    """Print the book every `secs_between_updates`. With `capture`, a
+    capture.CaptureWriter, also record every book fetched."""
     def print_order(order):
         print('  Price:{price:>9}, Qty:{qty:>6}'
                 .format(price=order['price'], qty=order['qty']))
 
+    def print_changes(name, side_delta):
+        print('  {}: {} added, {} removed, {} changed'.format(
+            name, len(side_delta.added), len(side_delta.removed),
+            len(side_delta.changed)))
+
+    book_stream = BookDeltaStream()
     try:
         while True:
             r = orderbook(venue, stock)
@@ -506,7 +496,18 @@ def rolling_orderbook(secs_between_updates, num_orders_visible):
                 print('Received status code {}'.format(r.status_code))
                 break
             r_json = r.json()
+            if capture is not None:
+                capture.orderbook(r_json)
+            delta = book_stream.push(OrderBookSnapshot.from_json(r_json))
+            if delta.prev is not None and delta.is_empty():
+                # Nothing new to show
+                time.sleep(secs_between_updates)
+                continue
+
             print('\nORDER BOOK as at {}'.format(r_json['ts']))
+            if delta.prev is not None:
+                print_changes('Asks', delta.asks)
+                print_changes('Bids', delta.bids)
             
             if r_json['asks'] is None:
                 print('  No asks')
@@ -529,42 +530,39 @@ def rolling_orderbook(secs_between_updates, num_orders_visible):
 
 
 
-class DummyClient(WebSocketClient):
-    def opened(self):
-        print('*******  OPEN  *******')
-
-    def closed(self, code, reason=None):
-        print('******* CLOSED *******')
-        print('Code: {}, reason: {}'.format(code, reason))
-
-    def received_message(self, m):
-        if m.is_text:
-            print('RECEIVED MESSAGE:')
-            j = json.loads(m)
-            pretty_j = None
-            if not j['ok']:
-                pretty_j = j
-            else:
-                pretty_j['standingID'] = j['standingID']
-                pretty_j['incomingID'] = j['incomingID']
-                pretty_j['filledAt'] = j['filledAt']
-                pretty_j['standingComplete'] = j['standingComplete']
-                pretty_j['incomingComplete'] = j['incomingComplete']
-                pretty_j['order'] = j['order']
-            print(json.dumps(pretty_j, indent = 4, separators=(',', ': ')))
-        else:
-            print('RECEIVED NONTEXT MESSAGE')
-
-
-def rolling_fills():
-    url = ('wss://api.stockfighter.io/ob/api/ws/{}/venues/{}/executions'
-               .format(account, venue, stock))
+def print_execution(message):
+    if not message['ok']:
+        print('EXECUTION ERROR: {}'.format(message.get('error')))
+        return
+    order = message['order']
+    print(('{direction:>4} ID {id}: {filled:>5} @ {price:>6} at {filledAt}, '
+           'standing {standingId}{standing_done}, incoming {incomingId}'
+           '{incoming_done}').format(
+               direction=order['direction'], id=order['id'],
+               standing_done=' (complete)' if message['standingComplete'] else '',
+               incoming_done=' (complete)' if message['incomingComplete'] else '',
+               **message))
+
+
+def rolling_fills(stock_purse=None, capture=None):
+    """Print our fills as they happen. With `stock_purse`, also apply them to
+    the purse, and with `capture`, a capture.CaptureWriter, record them."""
+    def on_execution(message):
+        if capture is not None:
+            capture.execution(message)
+        print_execution(message)
+
+    ws_url_base = (stock_purse or purse).ws_url_base()
+    consumer = ExecutionsConsumer(account, venue, ws_url_base=ws_url_base,
+                                  on_execution=on_execution)
+    if stock_purse is not None:
+        consumer.add_purse(stock_purse)
+    consumer.start()
     try:
-        ws = DummyClient(url)
-        ws.connect()
-        ws.run_forever()
+        while True:
+            time.sleep(1)
     except KeyboardInterrupt:
-        ws.close()
+        consumer.stop()
 
 
 def rolling_fills1():
@@ -583,8 +581,8 @@ def rolling_fills1():
         print('******* CLOSED *******')
 
     try:
-        url = ('wss://api.stockfighter.io/ob/api/ws/{}/venues/{}/executions/stocks/{}'
-               .format(account, venue, stock))
+        url = ('{}/{}/venues/{}/executions/stocks/{}'
+               .format(purse.ws_url_base(), account, venue, stock))
         websocket.enableTrace(True)
         ws = websocket.WebSocketApp(url,
                                     on_open=on_open, on_message=on_message,
@@ -611,8 +609,8 @@ def rolling_quotes1():
         print('******* CLOSED *******')
 
     try:
-        url = ('wss://api.stockfighter.io/ob/api/ws/{}/venues/{}/tickertape/stocks/{}'
-               .format(account, venue, stock))
+        url = ('{}/{}/venues/{}/tickertape/stocks/{}'
+               .format(purse.ws_url_base(), account, venue, stock))
         websocket.enableTrace(True)
         ws = websocket.WebSocketApp(url,
                                     on_open=on_open, on_message=on_message,
@@ -624,8 +622,8 @@ def rolling_quotes1():
 
 
 def test_fills1():
-    url = ('wss://api.stockfighter.io/ob/api/ws/{}/venues/{}/executions'
-               .format(account, venue, stock))
+    url = ('{}/{}/venues/{}/executions'
+               .format(purse.ws_url_base(), account, venue, stock))
     ws = websocket.create_connection(url)
     print('****** OPENED *******')
     res = ws.recv()
@@ -633,3 +631,10 @@ def test_fills1():
     print('****** CLOSING *******')
     ws.close()
 
+
+if __name__ == '__main__':
+    # Console and log output are written on a background thread, so a slow
+    # terminal can't hold up orders. Only when run as a script: backtest.py
+    # and sweep.py import this module, and sweep's forked workers would
+    # inherit a queue whose writer thread didn't survive the fork.
+    output = asyncoutput.install()
@@ -0,0 +1,128 @@
+"""Backtest one strategy over a grid of parameters, one process per core.
+
+Each NAME=VALUE is JSON. A list is a grid axis, anything else is held
+fixed, so to sweep a parameter that is itself a list, wrap its values in
+another list:
+
+    python sweep.py recording.jsonl decrease_maker \\
+        target_price=[3000,4000] crash_price_delta=[200,400] \\
+        'qtys=[[50,200],[100,100]]' max_rounds=4
+
+Results print as each backtest finishes, then as a table best NAV first.
+"""
+
+from __future__ import print_function
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import traceback
+
+import strats
+from backtest import load_recording, parse_params, parse_time, run_backtest
+
+
+# Set in each worker by _init_worker(), so the recording is loaded once per
+# process rather than once per backtest
+_events = None
+_latency = None
+
+
+def expand_grid(params):
+    """{'a': [1, 2], 'b': 3} to [{'a': 1, 'b': 3}, {'a': 2, 'b': 3}]."""
+    names = sorted(params)
+    axes = [params[name] if isinstance(params[name], list)
+            else [params[name]] for name in names]
+    return [dict(zip(names, values)) for values in itertools.product(*axes)]
+
+
+def _init_worker(recording, latency, start, end):
+    global _events, _latency
+    _events = load_recording(recording, start, end)
+    _latency = latency
+
+
+def _run_one(task):
+    strategy_name, params = task
+    try:
+        # run_backtest() builds a fresh simulated venue for every run
+        purse = run_backtest(getattr(strats, strategy_name), _events, params,
+                             latency=_latency, quiet=True)
+    except Exception:
+        return {'params': params, 'error': traceback.format_exc()}
+    return {'params': params, 'nav': purse.value(),
+            'position': purse.position(), 'basis': purse.basis()}
+
+
+def sweep(recording, strategy_name, grid, processes=None, latency=0.001,
+          start=None, end=None):
+    """Yield a result dict per parameter set in `grid`, in the order they
+    finish. Results have 'params' and either 'nav', 'position' and 'basis',
+    or 'error'."""
+    tasks = [(strategy_name, params) for params in grid]
+    pool = multiprocessing.Pool(processes, _init_worker,
+                                (recording, latency, start, end))
+    try:
+        for result in pool.imap_unordered(_run_one, tasks):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def format_params(params):
+    return ' '.join('{}={}'.format(name, json.dumps(params[name]))
+                    for name in sorted(params))
+
+
+def format_result(result):
+    if 'error' in result:
+        return '{:>10} {:>9} {:>11}  {}  ERROR {}'.format(
+            '', '', '', format_params(result['params']),
+            result['error'].strip().split('\n')[-1])
+    return '{:>10} {:>9} {:>11}  {}'.format(
+        result['nav'], result['position'], result['basis'],
+        format_params(result['params']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('recording')
+    parser.add_argument('strategy', help='Function name in strats.py')
+    parser.add_argument('params', nargs='*', metavar='NAME=VALUE')
+    parser.add_argument('--processes', type=int,
+                        help='Default is one per core')
+    parser.add_argument('--latency', type=float, default=0.001,
+                        help='Virtual seconds per API call')
+    parser.add_argument('--start', type=parse_time,
+                        help='Venue timestamp or epoch seconds to start at')
+    parser.add_argument('--end', type=parse_time,
+                        help='Venue timestamp or epoch seconds to stop at')
+    args = parser.parse_args()
+
+    grid = expand_grid(parse_params(args.params))
+    header = '{:>10} {:>9} {:>11}  {}'.format(
+        'NAV', 'position', 'basis', 'params')
+
+    print('Running {} backtests of {}'.format(len(grid), args.strategy))
+    print(header)
+    results = []
+    for result in sweep(args.recording, args.strategy, grid,
+                        args.processes, args.latency, args.start,
+                        args.end):
+        print(format_result(result))
+        results.append(result)
+
+    def nav(result):
+        value = result.get('nav')
+        return float('-inf') if value is None else value
+
+    print('\nBest first:')
+    print(header)
+    for result in sorted(results, key=nav, reverse=True):
+        print(format_result(result))
+
+
+if __name__ == '__main__':
+    main()
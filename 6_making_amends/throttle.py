@@ -0,0 +1,181 @@
+"""Client-side rate limiting for API calls, see APISession's `throttle`.
+
+Requests draw from one of three token buckets, by what they are for:
+
+    order        placing orders
+    cancel       cancelling them
+    market_data  quotes, orderbooks and order statuses
+
+A request that finds its bucket empty waits for the next token rather than
+being sent for the venue to reject. Cancels come first: when the cancel
+bucket runs dry a cancel borrows from the order bucket, and orders wait
+until every cancel already queued has gone, so getting out of the market
+never waits behind getting into it.
+
+Buckets start at their maximum rate and only slow down when the venue says
+so, AIMD style as in TCP. A 429 or 5xx, or a request that got no response
+at all, halves the rate, at most once a `backoff_secs`, and a Retry-After
+on a 429 also holds the bucket back until then. Every response that comes
+back fine nudges the rate back up towards its maximum. Latency alone
+doesn't count against a bucket, it can't tell the venue slowing down from
+requests queueing in our own client.
+"""
+
+from __future__ import print_function
+
+import threading
+import time
+
+try:
+    from time import monotonic
+except ImportError:
+    # Python 2
+    from time import time as monotonic
+
+
+BUDGETS = ('order', 'cancel', 'market_data')
+
+# The budget each APISession endpoint draws from
+ENDPOINT_BUDGETS = {
+    'order': 'order',
+    'cancel': 'cancel',
+    'quote': 'market_data',
+    'orderbook': 'market_data',
+    'order_status': 'market_data',
+}
+
+
+class TokenBucket(object):
+    """Tokens accrue at `rate` a second up to `burst`. Taking one when there
+    are none puts the bucket in debt, and the taker waits for it to be paid
+    off, so waiters are served in the order they took."""
+
+    def __init__(self, rate, burst, min_rate, max_rate):
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.tokens = burst
+        self.paused_until = 0.0
+        self._updated = monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def take(self, now):
+        """Take a token, returns the seconds to wait before using it."""
+        self.refill(now)
+        self.tokens -= 1
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(wait, self.paused_until - now)
+
+
+class Throttle(object):
+    """A TokenBucket per budget in BUDGETS, each allowing up to `max_rates`
+    requests a second and backing off as far as `min_rate`. Safe to use
+    from several threads, and to share between an APISession and an
+    AsyncAPISession so they spend from the same budgets.
+
+    Blocking callers use acquire(), async ones wait out what reserve()
+    returns themselves. Either way, call record() with the outcome."""
+
+    MAX_RATES = {'order': 100.0, 'cancel': 200.0, 'market_data': 50.0}
+
+    def __init__(self, max_rates=None, min_rate=0.5, burst_secs=0.5,
+                 increase=5.0, backoff_secs=1.0):
+        max_rates = dict(self.MAX_RATES, **(max_rates or {}))
+        self._lock = threading.Lock()
+        self._burst_secs = burst_secs
+        self._increase = increase
+        self._backoff_secs = backoff_secs
+        self._buckets = {}
+        for budget in BUDGETS:
+            rate = max_rates[budget]
+            self._buckets[budget] = TokenBucket(
+                rate, self._burst(rate), min_rate, rate)
+        self._last_backoff = dict.fromkeys(BUDGETS, 0.0)
+        # When the last cancel queued so far will go, orders wait for it
+        self._cancels_until = 0.0
+        self.num_throttled = dict.fromkeys(BUDGETS, 0)
+        self.num_backoffs = dict.fromkeys(BUDGETS, 0)
+
+    def _burst(self, rate):
+        return max(1.0, rate * self._burst_secs)
+
+    def rate(self, budget):
+        """Current requests a second allowed for `budget`."""
+        with self._lock:
+            return self._buckets[budget].rate
+
+    def reserve(self, budget):
+        """Take a token from `budget`, returns the seconds to wait before
+        sending."""
+        with self._lock:
+            now = monotonic()
+            bucket = self._buckets[budget]
+            if budget == 'cancel':
+                bucket.refill(now)
+                order_bucket = self._buckets['order']
+                order_bucket.refill(now)
+                if bucket.tokens < 1 and order_bucket.tokens >= 1:
+                    bucket = order_bucket
+            wait = bucket.take(now)
+            if budget == 'cancel':
+                self._cancels_until = max(self._cancels_until, now + wait)
+            elif budget == 'order':
+                wait = max(wait, self._cancels_until - now)
+            if wait > 0:
+                self.num_throttled[budget] += 1
+            return wait
+
+    def acquire(self, budget):
+        """reserve() then sleep until the request can go."""
+        wait = self.reserve(budget)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def record(self, budget, status_code, retry_after=None):
+        """Adapt `budget` to a response, `status_code` None if there was no
+        response. `retry_after` is the response's Retry-After header."""
+        with self._lock:
+            now = monotonic()
+            bucket = self._buckets[budget]
+            throttled = status_code is None or status_code == 429 or \
+                status_code >= 500
+
+            if throttled:
+                if now - self._last_backoff[budget] >= self._backoff_secs:
+                    self._last_backoff[budget] = now
+                    self.num_backoffs[budget] += 1
+                    self._set_rate(bucket, now, bucket.rate / 2)
+                if status_code == 429 and retry_after is not None:
+                    try:
+                        bucket.paused_until = max(
+                            bucket.paused_until, now + float(retry_after))
+                    except ValueError:
+                        # An HTTP date, rather than seconds
+                        pass
+            elif bucket.rate < bucket.max_rate:
+                # About `increase` requests a second more for each second
+                # spent at the current rate
+                self._set_rate(bucket, now,
+                               bucket.rate + self._increase / bucket.rate)
+
+    def _set_rate(self, bucket, now, rate):
+        bucket.refill(now)
+        bucket.rate = min(max(rate, bucket.min_rate), bucket.max_rate)
+        bucket.burst = self._burst(bucket.rate)
+        bucket.tokens = min(bucket.tokens, bucket.burst)
+
+    def report(self):
+        lines = ['{:<12} {:>9} {:>10} {:>9}'.format(
+            'budget', 'rate/s', 'throttled', 'backoffs')]
+        with self._lock:
+            for budget in BUDGETS:
+                lines.append('{:<12} {:>9.1f} {:>10} {:>9}'.format(
+                    budget, self._buckets[budget].rate,
+                    self.num_throttled[budget], self.num_backoffs[budget]))
+        return '\n'.join(lines)
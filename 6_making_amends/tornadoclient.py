@@ -1,5 +1,240 @@
+from __future__ import print_function
+
+import collections
+import logging
+import ssl
+import time
+from io import BytesIO
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.httpclient import HTTPError, HTTPRequest, HTTPResponse
+from tornado.httputil import HTTPHeaders, parse_response_start_line
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+from tornado.locks import Semaphore
+from tornado.simple_httpclient import HTTPStreamClosedError, HTTPTimeoutError
+from tornado.tcpclient import TCPClient
 
 
 class PipeliningHTTPClient:
+    """HTTP/1.1 client that writes every request straight onto one kept-alive
+    connection without waiting for the responses to the earlier ones. The
+    server has to answer in the order it was asked, so responses are handed
+    back to callers first-in, first-out.
+
+    fetch() takes the same arguments as AsyncHTTPClient.fetch() that
+    AsyncAPISession uses, so it can be swapped in as its client. All requests
+    must go to the one host.
+
+    If the connection drops, every request still waiting on a response fails
+    with HTTPStreamClosedError. Orders aren't idempotent, so they are not
+    resent; the next fetch() opens a new connection. Connecting has
+    `connect_timeout` seconds, and each request `request_timeout` from
+    being written. A request that times out fails with HTTPTimeoutError and
+    closes the connection, as every response queued behind it would be
+    stuck too. Like tornado's own clients, with `raise_error` False these
+    errors come back as a response with code 599 instead."""
+
+    def __init__(self, host, port=443, use_tls=True, max_in_flight=32,
+                 connect_timeout=20, request_timeout=20):
+        self._host = host
+        self._port = port
+        self._connect_timeout = connect_timeout
+        self._request_timeout = request_timeout
+        self._ssl_options = ssl.create_default_context() if use_tls else None
+        self._tcp_client = TCPClient()
+        self._stream = None
+        # (request, start time, future) for every request written to
+        # self._stream but not yet answered, in the order they were written.
+        # Each connection has its own, so one dropping can't fail requests
+        # already written to the next.
+        self._pending = None
+        self._connecting = None
+        self._in_flight = Semaphore(max_in_flight)
+
+    @classmethod
+    def for_url(cls, url, **kwargs):
+        parts = urlsplit(url)
+        use_tls = parts.scheme == 'https'
+        port = parts.port or (443 if use_tls else 80)
+        return cls(parts.hostname, port, use_tls, **kwargs)
+
+    def close(self):
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+
+    @gen.coroutine
+    def fetch(self, url, method='GET', body=None, headers=None,
+              raise_error=True, header_callback=None):
+        request = HTTPRequest(url, method=method, headers=headers,
+                              header_callback=header_callback)
+        start_time = time.time()
+        yield self._in_flight.acquire()
+        try:
+            stream, pending = yield self._get_stream()
+
+            future = Future()
+            # No yield between the write and the append, so the order of
+            # `pending` matches the order requests went out on the wire.
+            stream.write(self._encode_request(url, method, body, headers))
+            pending.append((request, start_time, future))
+
+            io_loop = IOLoop.current()
+            timeout = io_loop.call_later(self._request_timeout,
+                                         self._on_timeout, stream, future)
+            try:
+                resp = yield future
+            finally:
+                io_loop.remove_timeout(timeout)
+        except (HTTPTimeoutError, StreamClosedError, IOError, OSError) as e:
+            if isinstance(e, StreamClosedError):
+                e = HTTPStreamClosedError('Stream closed')
+            if raise_error:
+                raise e
+            raise gen.Return(HTTPResponse(
+                request, 599, error=e, request_time=time.time() - start_time))
+        finally:
+            self._in_flight.release()
+
+        if raise_error and resp.code >= 400:
+            raise HTTPError(resp.code, resp.reason, resp)
+        raise gen.Return(resp)
+
+    @gen.coroutine
+    def _get_stream(self):
+        if self._stream is not None and not self._stream.closed():
+            raise gen.Return((self._stream, self._pending))
+
+        # Only open one connection even if many fetches arrive at once
+        if self._connecting is None:
+            self._connecting = gen.convert_yielded(self._tcp_client.connect(
+                self._host, self._port, ssl_options=self._ssl_options,
+                timeout=self._connect_timeout))
+        connecting = self._connecting
+        try:
+            stream = yield connecting
+        except gen.TimeoutError:
+            raise HTTPTimeoutError('while connecting')
+        finally:
+            if self._connecting is connecting:
+                self._connecting = None
+
+        if self._stream is not stream:
+            self._stream = stream
+            self._pending = collections.deque()
+            self._read_responses(stream, self._pending)
+        raise gen.Return((self._stream, self._pending))
+
+    def _on_timeout(self, stream, future):
+        if not future.done():
+            future.set_exception(HTTPTimeoutError('during request'))
+            # Fails everything pending behind it too
+            stream.close()
+
+    def _encode_request(self, url, method, body, headers):
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        if body is None:
+            body = b''
+        elif not isinstance(body, bytes):
+            body = body.encode('utf-8')
+
+        lines = ['{} {} HTTP/1.1'.format(method, path),
+                 'Host: {}'.format(self._host),
+                 'Connection: keep-alive']
+        if body or method in ('POST', 'PUT'):
+            lines.append('Content-Length: {}'.format(len(body)))
+        for name, value in (headers or {}).items():
+            lines.append('{}: {}'.format(name, value))
+
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('utf-8') + body
+
+    @gen.coroutine
+    def _read_responses(self, stream, pending):
+        try:
+            while True:
+                header_data = yield stream.read_until(b'\r\n\r\n')
+                header_text = header_data.decode('latin1')
+                start_line, _, header_lines = header_text.partition('\r\n')
+                start_line = parse_response_start_line(start_line)
+                headers = HTTPHeaders.parse(header_lines)
+
+                if not pending:
+                    logging.warning(
+                        'unsolicited response from %s: %s',
+                        self._host, header_text)
+                    break
+                request, start_time, future = pending[0]
+                if request.header_callback is not None:
+                    # Line by line, as tornado's own clients do
+                    for line in header_text.split('\r\n')[:-1]:
+                        request.header_callback(line + '\r\n')
+
+                body = yield self._read_body(stream, request, start_line,
+                                             headers)
+
+                pending.popleft()
+                if not future.done():
+                    future.set_result(HTTPResponse(
+                        request, start_line.code, reason=start_line.reason,
+                        headers=headers, buffer=BytesIO(body),
+                        request_time=time.time() - start_time))
+
+                if headers.get('Connection', '').lower() == 'close':
+                    break
+        except StreamClosedError:
+            pass
+        finally:
+            stream.close()
+            if self._stream is stream:
+                self._stream = None
+                self._pending = None
+            _fail_pending(pending)
+
+    @gen.coroutine
+    def _read_body(self, stream, request, start_line, headers):
+        if (request.method == 'HEAD' or start_line.code in (204, 304) or
+                100 <= start_line.code < 200):
+            raise gen.Return(b'')
+
+        if headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size_line = yield stream.read_until(b'\r\n')
+                size = int(size_line.split(b';')[0].strip(), 16)
+                if size == 0:
+                    # Skip any trailers
+                    while (yield stream.read_until(b'\r\n')) != b'\r\n':
+                        pass
+                    break
+                chunk = yield stream.read_bytes(size + 2)
+                chunks.append(chunk[:-2])
+            raise gen.Return(b''.join(chunks))
+
+        if 'Content-Length' in headers:
+            length = int(headers['Content-Length'])
+            if length == 0:
+                raise gen.Return(b'')
+            body = yield stream.read_bytes(length)
+            raise gen.Return(body)
+
+        # No length, so the body runs to the end of the connection
+        body = yield stream.read_until_close()
+        raise gen.Return(body)
+
 
-    
\ No newline at end of file
+def _fail_pending(pending):
+    while pending:
+        _, _, future = pending.popleft()
+        if not future.done():
+            future.set_exception(StreamClosedError())
@@ -0,0 +1,335 @@
+"""A stand-in for the Stockfighter venue API, for running and timing
+strategies offline.
+
+Serves the same REST routes (heartbeat, quote, orderbook, order POST, order
+status GET and DELETE) and websocket routes (tickertape, executions) under
+/ob/api, so pointing StockPurse at it is just
+
+    StockPurse(venue, stock, account, url_base='http://localhost:8081/ob/api')
+
+The websockets follow from the purse, see StockPurse.ws_url_base().
+
+Run it with
+
+    python venue_sim.py --port 8081 --stock TESTEX:FOOBAR --seed-price 5000
+"""
+
+from __future__ import print_function
+
+import argparse
+import itertools
+import json
+import threading
+
+from tornado import web, websocket
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.netutil import bind_sockets
+
+from matching import ORDER_TYPES, MatchingEngine
+
+
+class OrderError(Exception):
+    def __init__(self, status_code, error_msg):
+        self.status_code = status_code
+        self.error_msg = error_msg
+
+
+class SimVenue:
+    """All the books, plus the orders across them by ID. Listeners get
+    every tickertape and executions message, see add_listener()."""
+
+    def __init__(self, stocks):
+        """`stocks` is an iterable of (venue, symbol)."""
+        self._order_ids = itertools.count(1)
+        self._books = {}
+        for venue, symbol in stocks:
+            self._books[(venue, symbol)] = MatchingEngine(
+                venue, symbol, self._order_ids)
+        self._orders = {}
+        self._listeners = []
+
+    def add_listener(self, listener):
+        """`listener` is called with (kind, account, venue, symbol, message)
+        where `kind` is 'tickertape' or 'executions'. `account` is None for
+        tickertape messages."""
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    def has_venue(self, venue):
+        return any(v == venue for v, _ in self._books)
+
+    def book(self, venue, symbol):
+        try:
+            return self._books[(venue, symbol)]
+        except KeyError:
+            raise OrderError(
+                404, 'No venue exists with the symbol {} on {}'
+                .format(symbol, venue))
+
+    def order_status(self, venue, symbol, id):
+        self.book(venue, symbol)
+        order = self._orders.get(id)
+        if order is None or order.venue != venue or order.symbol != symbol:
+            raise OrderError(404, 'No order {} on {}'.format(id, venue))
+        return order
+
+    def place(self, venue, symbol, account, direction, order_type, qty,
+              price=None):
+        if direction not in ('buy', 'sell'):
+            raise OrderError(400, 'Invalid direction {}'.format(direction))
+        if order_type not in ORDER_TYPES:
+            raise OrderError(400, 'Invalid order type {}'.format(order_type))
+        if not isinstance(qty, int) or qty <= 0:
+            raise OrderError(400, 'Invalid qty {}'.format(qty))
+        if order_type != 'market' and (not isinstance(price, int) or
+                                       price < 0):
+            raise OrderError(400, 'Invalid price {}'.format(price))
+
+        book = self.book(venue, symbol)
+        order, fills = book.submit(account, direction, order_type, qty, price)
+        self._orders[order.id] = order
+
+        for fill in fills:
+            standing = fill.standing.to_json(fill.standing_num_fills)
+            incoming = fill.incoming.to_json(fill.incoming_num_fills)
+            for own in (standing, incoming):
+                self._notify('executions', own['account'], venue, symbol, {
+                    'ok': True,
+                    'account': own['account'],
+                    'venue': venue,
+                    'symbol': symbol,
+                    'order': own,
+                    'standingId': standing['id'],
+                    'incomingId': incoming['id'],
+                    'price': fill.price,
+                    'filled': fill.qty,
+                    'filledAt': fill.ts,
+                    'standingComplete': not standing['open'],
+                    'incomingComplete': not incoming['open'],
+                })
+        self._notify_quote(book)
+
+        return order
+
+    def cancel(self, venue, symbol, account, id):
+        order = self.order_status(venue, symbol, id)
+        if order.account != account:
+            raise OrderError(
+                401, 'Not authorized to delete order {}'.format(id))
+        self.book(venue, symbol).cancel(order)
+        self._notify_quote(self.book(venue, symbol))
+        return order
+
+    def _notify_quote(self, book):
+        self._notify('tickertape', None, book.venue, book.symbol,
+                     {'ok': True, 'quote': book.quote_json()})
+
+    def _notify(self, kind, account, venue, symbol, message):
+        for listener in list(self._listeners):
+            listener(kind, account, venue, symbol, message)
+
+    def seed(self, venue, symbol, price, levels=10, spread=50, step=10,
+             qty=100, account='SIMMM'):
+        """Rest a ladder of bids and asks around `price`, so strategies that
+        need both sides of the book have something to look at. One share
+        also trades at `price` so quotes have a last price."""
+        self.place(venue, symbol, account, 'sell', 'limit', 1, price)
+        self.place(venue, symbol, account, 'buy', 'limit', 1, price)
+        for level in range(levels):
+            offset = spread // 2 + level * step
+            self.place(venue, symbol, account, 'buy', 'limit', qty,
+                       max(price - offset, 0))
+            self.place(venue, symbol, account, 'sell', 'limit', qty,
+                       price + offset)
+
+
+### HTTP and websocket front end
+
+
+class APIHandler(web.RequestHandler):
+    def initialize(self, venue_sim):
+        self.venue_sim = venue_sim
+
+    def write_json(self, body, status_code=200):
+        self.set_status(status_code)
+        self.set_header('Content-Type', 'application/json')
+        self.finish(json.dumps(body))
+
+    def write_error_json(self, status_code, error_msg):
+        self.write_json({'ok': False, 'error': error_msg}, status_code)
+
+    def account(self):
+        # The sim doesn't know real keys, it only checks one is sent
+        if not self.request.headers.get('X-Starfighter-Authorization'):
+            raise OrderError(401, 'Authorization header required')
+
+
+class HeartbeatHandler(APIHandler):
+    def get(self, venue=None):
+        if venue is not None and not self.venue_sim.has_venue(venue):
+            self.write_error_json(404, 'No venue exists with symbol {}'
+                                  .format(venue))
+        elif venue is not None:
+            self.write_json({'ok': True, 'venue': venue})
+        else:
+            self.write_json({'ok': True, 'error': ''})
+
+
+class OrderbookHandler(APIHandler):
+    def get(self, venue, symbol):
+        try:
+            self.write_json(self.venue_sim.book(venue, symbol).orderbook_json())
+        except OrderError as e:
+            self.write_error_json(e.status_code, e.error_msg)
+
+
+class QuoteHandler(APIHandler):
+    def get(self, venue, symbol):
+        try:
+            self.write_json(self.venue_sim.book(venue, symbol).quote_json())
+        except OrderError as e:
+            self.write_error_json(e.status_code, e.error_msg)
+
+
+class OrdersHandler(APIHandler):
+    def post(self, venue, symbol):
+        try:
+            self.account()
+            try:
+                body = json.loads(self.request.body.decode('utf-8'))
+            except ValueError:
+                raise OrderError(400, 'Invalid JSON body')
+            if body.get('venue', venue) != venue:
+                raise OrderError(400, 'Venue in body does not match URL')
+            if body.get('stock', body.get('symbol', symbol)) != symbol:
+                raise OrderError(400, 'Stock in body does not match URL')
+            order = self.venue_sim.place(
+                venue, symbol, body.get('account'), body.get('direction'),
+                body.get('orderType'), body.get('qty'), body.get('price'))
+        except OrderError as e:
+            self.write_error_json(e.status_code, e.error_msg)
+        else:
+            self.write_json(order.to_json())
+
+
+class OrderHandler(APIHandler):
+    def get(self, venue, symbol, id):
+        try:
+            self.account()
+            order = self.venue_sim.order_status(venue, symbol, int(id))
+        except OrderError as e:
+            self.write_error_json(e.status_code, e.error_msg)
+        else:
+            self.write_json(order.to_json())
+
+    def delete(self, venue, symbol, id):
+        try:
+            self.account()
+            # Real keys map to accounts, here any caller owns every order
+            order = self.venue_sim.order_status(venue, symbol, int(id))
+            order = self.venue_sim.cancel(venue, symbol, order.account,
+                                          order.id)
+        except OrderError as e:
+            self.write_error_json(e.status_code, e.error_msg)
+        else:
+            self.write_json(order.to_json())
+
+
+class FeedHandler(websocket.WebSocketHandler):
+    """Streams one account's executions, or the tickertape, for a venue and
+    optionally a single stock."""
+
+    def initialize(self, venue_sim, kind):
+        self.venue_sim = venue_sim
+        self.kind = kind
+
+    def open(self, account, venue, symbol=None):
+        self.account = account
+        self.venue = venue
+        self.symbol = symbol
+        self.io_loop = IOLoop.current()
+        self.venue_sim.add_listener(self.on_venue_message)
+
+    def on_venue_message(self, kind, account, venue, symbol, message):
+        if (kind == self.kind and venue == self.venue and
+                (self.symbol is None or symbol == self.symbol) and
+                (kind == 'tickertape' or account == self.account)):
+            # The venue may be driven from another thread
+            self.io_loop.add_callback(self.write_message, json.dumps(message))
+
+    def on_close(self):
+        self.venue_sim.remove_listener(self.on_venue_message)
+
+
+def make_app(venue_sim):
+    base = r'/ob/api'
+    stock = r'/venues/(\w+)/stocks/(\w+)'
+    ws_venue = r'/ws/(\w+)/venues/(\w+)'
+    args = {'venue_sim': venue_sim}
+    return web.Application([
+        (base + r'/heartbeat', HeartbeatHandler, args),
+        (base + r'/venues/(\w+)/heartbeat', HeartbeatHandler, args),
+        (base + stock, OrderbookHandler, args),
+        (base + stock + r'/quote', QuoteHandler, args),
+        (base + stock + r'/orders', OrdersHandler, args),
+        (base + stock + r'/orders/(\d+)', OrderHandler, args),
+        (base + ws_venue + r'/tickertape(?:/stocks/(\w+))?', FeedHandler,
+         dict(args, kind='tickertape')),
+        (base + ws_venue + r'/executions(?:/stocks/(\w+))?', FeedHandler,
+         dict(args, kind='executions')),
+    ])
+
+
+def start_in_thread(venue_sim, port=0):
+    """Serve `venue_sim` from a daemon thread. Returns the base REST URL,
+    e.g. 'http://127.0.0.1:8081/ob/api'. With port 0 a free one is picked."""
+    started = threading.Event()
+    result = {}
+
+    def listen():
+        sockets = bind_sockets(port, '127.0.0.1')
+        HTTPServer(make_app(venue_sim)).add_sockets(sockets)
+        result['port'] = sockets[0].getsockname()[1]
+
+    def serve():
+        io_loop = IOLoop()
+        io_loop.run_sync(listen)
+        started.set()
+        io_loop.start()
+
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    started.wait()
+
+    return 'http://127.0.0.1:{}/ob/api'.format(result['port'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--stock', action='append', metavar='VENUE:SYMBOL',
+                        help='Stock to list, may be repeated. '
+                             'Default TESTEX:FOOBAR')
+    parser.add_argument('--seed-price', type=int,
+                        help='Rest a ladder of orders around this price on '
+                             'every stock')
+    args = parser.parse_args()
+
+    stocks = [tuple(s.split(':')) for s in (args.stock or ['TESTEX:FOOBAR'])]
+    venue_sim = SimVenue(stocks)
+    if args.seed_price is not None:
+        for venue, symbol in stocks:
+            venue_sim.seed(venue, symbol, args.seed_price)
+
+    make_app(venue_sim).listen(args.port)
+    print('Serving {} on http://localhost:{}/ob/api'.format(
+        ', '.join(':'.join(s) for s in stocks), args.port))
+    IOLoop.current().start()
+
+
+if __name__ == '__main__':
+    main()